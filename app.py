@@ -1,11 +1,26 @@
 import streamlit as st
 import json
-import requests
 from datetime import datetime
 import random
 import os
+import uuid
+from typing import Dict, Optional, Tuple
+from disk_cache import DiskCache, make_llm_key, normalize_prompt
+from async_runner import run_sync
+from caption_formatter import LocalCaptionFormatter
+from circuit_breaker import breaker_states
+from conversation_memory import ConversationMemory
 from groq_handler import GroqHandler
-from image_handler import ImageHandler
+from hedging import Hedger
+from image_handler import ImageHandler, download_engine, download_flights, race_stats, search_flights
+from image_index import PerceptualImageCache
+from offline_analyzer import analyze_offline
+from llm_gateway import GROQ_BASE_URL, XAI_BASE_URL, LLMGateway, ProviderConfig
+from model_router import DEFAULT_ROUTES, ModelRouter
+from similarity_cache import SimilarityCache
+from singleflight import SingleFlight
+from template_library import TemplateLibrary
+from token_usage import UsageTracker, current_session
 
 # Page configuration
 st.set_page_config(
@@ -53,25 +68,197 @@ if "chat_history" not in st.session_state:
 if "current_meme" not in st.session_state:
     st.session_state.current_meme = None
 
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+if "memory" not in st.session_state:
+    # Token budget for the conversation context sent with each chat reply
+    st.session_state.memory = ConversationMemory(budget=int(st.secrets.get("chat_memory_tokens", 1500)))
+
+# Attribute token usage of this script run to the session
+current_session.set(st.session_state.session_id)
+
+@st.cache_resource
+def get_llm_cache() -> DiskCache:
+    """Response cache shared by all sessions; persisted in cache/ across restarts."""
+    return DiskCache(
+        os.path.join("cache", "llm_responses.sqlite3"),
+        ttl=float(st.secrets.get("llm_cache_ttl", 24 * 3600)),
+        max_entries=int(st.secrets.get("llm_cache_max_entries", 5000))
+    )
+
+@st.cache_resource
+def get_image_search_cache() -> DiskCache:
+    """Image search results shared by all sessions; persisted in cache/ across restarts."""
+    return DiskCache(
+        os.path.join("cache", "image_search.sqlite3"),
+        ttl=float(st.secrets.get("image_search_cache_ttl", 7 * 24 * 3600)),
+        max_entries=int(st.secrets.get("image_search_cache_max_entries", 2000))
+    )
+
+@st.cache_resource
+def get_image_cache() -> PerceptualImageCache:
+    """Downloaded images shared by all sessions, deduplicated by perceptual hash."""
+    return PerceptualImageCache(
+        os.path.join("cache", "images"),
+        max_distance=int(st.secrets.get("image_hash_distance", 6)),
+        max_entries=int(st.secrets.get("image_cache_max_entries", 500))
+    )
+
+@st.cache_resource
+def get_template_library() -> Optional[TemplateLibrary]:
+    """Local meme templates from the template_dir secret, indexed once per process (off when unset)."""
+    directory = st.secrets.get("template_dir")
+    if not directory:
+        return None
+    return TemplateLibrary(
+        directory,
+        threshold=float(st.secrets.get("template_match_threshold", 0.5)),
+        min_coverage=float(st.secrets.get("template_min_coverage", 1.0))
+    )
+
+@st.cache_resource
+def get_similarity_cache() -> SimilarityCache:
+    """Near-duplicate prompt index shared by all sessions."""
+    return SimilarityCache(
+        threshold=float(st.secrets.get("similarity_threshold", 0.7)),
+        max_entries=int(st.secrets.get("similarity_max_entries", 1000))
+    )
+
+def _model_limits(secret: str) -> Dict[str, Dict[str, int]]:
+    """Per-model rate limit overrides from a secrets table of model -> limits."""
+    return {model: dict(limits) for model, limits in st.secrets.get(secret, {}).items()}
+
+@st.cache_resource
+def get_llm_gateway() -> LLMGateway:
+    """Pooled connections to both LLM providers, shared by all sessions.
+
+    Set groq_base_url / xai_base_url in secrets to point at mock_llm_server.py.
+    Rate limits apply per model; the *_requests_per_minute / *_tokens_per_minute
+    defaults can be overridden per model with a [groq_model_limits."<model>"]
+    (or xai_model_limits) table.
+    """
+    return LLMGateway({
+        "groq": ProviderConfig(
+            st.secrets.get("groq_base_url", GROQ_BASE_URL),
+            st.secrets["groq_api_key"],
+            read_timeout=30.0,
+            requests_per_minute=st.secrets.get("groq_requests_per_minute", 30),
+            tokens_per_minute=st.secrets.get("groq_tokens_per_minute", 6000),
+            model_limits=_model_limits("groq_model_limits")
+        ),
+        "xai": ProviderConfig(
+            st.secrets.get("xai_base_url", XAI_BASE_URL),
+            st.secrets.get("grok_api_key", st.secrets["groq_api_key"]),
+            read_timeout=60.0,
+            requests_per_minute=st.secrets.get("xai_requests_per_minute", 60),
+            tokens_per_minute=st.secrets.get("xai_tokens_per_minute"),
+            model_limits=_model_limits("xai_model_limits")
+        )
+    })
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Per-call-type model routing; override with a [model_routes] table in secrets."""
+    routes = dict(DEFAULT_ROUTES)
+    routes.update({call_type: list(models) for call_type, models in st.secrets.get("model_routes", {}).items()})
+    return ModelRouter(routes)
+
+@st.cache_resource
+def get_hedgers() -> Dict[str, Hedger]:
+    """Latency-percentile hedgers for the chat and analysis paths (enable with hedging = true)."""
+    percentile = float(st.secrets.get("hedge_percentile", 0.9))
+    return {"chat": Hedger(percentile), "analysis": Hedger(percentile)}
+
+HEDGING = bool(st.secrets.get("hedging", False))
+
+@st.cache_resource
+def get_usage_tracker() -> UsageTracker:
+    """Token usage per call type and session; drives adaptive max_tokens."""
+    return UsageTracker()
+
+@st.cache_resource
+def get_caption_formatter() -> LocalCaptionFormatter:
+    return LocalCaptionFormatter()
+
+@st.cache_resource
+def get_groq_handler() -> GroqHandler:
+    return GroqHandler(get_llm_gateway(), cache=get_llm_cache(), similarity_cache=get_similarity_cache(),
+                       router=get_model_router(), hedger=get_hedgers()["analysis"] if HEDGING else None,
+                       usage=get_usage_tracker(), local_formatter=get_caption_formatter())
+
+@st.cache_resource
+def get_meme_flights() -> SingleFlight:
+    """Coalesces identical in-flight meme prompts across sessions."""
+    return SingleFlight()
+
 # Initialize handlers
-groq_handler = GroqHandler(st.secrets["groq_api_key"])
-image_handler = ImageHandler()
+llm_cache = get_llm_cache()
+llm_gateway = get_llm_gateway()
+groq_handler = get_groq_handler()
+image_handler = ImageHandler(search_cache=get_image_search_cache(),
+                             candidates=int(st.secrets.get("image_candidates", 3)),
+                             templates=get_template_library(),
+                             image_cache=get_image_cache())
+
+# Set two_step_analysis = true in secrets to analyze and format captions in separate calls
+TWO_STEP_ANALYSIS = bool(st.secrets.get("two_step_analysis", False))
+
+# Seconds to wait for the LLM analysis before falling back to the offline analyzer
+ANALYSIS_TIMEOUT = float(st.secrets.get("analysis_timeout", 8.0))
+
+# Seconds the chat reply waits for the conversation summary; on timeout older turns are dropped
+SUMMARY_TIMEOUT = float(st.secrets.get("summary_timeout", 3.0))
+
+def build_meme(prompt: str, fast_mode: bool = False) -> Tuple[Optional[Dict], Optional[bytes]]:
+    """Analyze the prompt and render the meme; returns (analysis, meme_bytes)."""
+    # Start the image search as soon as the streamed analysis yields a query
+    prefetched = {}
+
+    def on_search_query(query: str):
+        if image_handler.match_template([query]) is None:
+            prefetched[query] = image_handler.prefetch_search(query)
+
+    # Step 1: Analyze the meme request (single call returns a ready-to-render caption)
+    analysis = None
+    # Skip straight to the offline analyzer while Groq's circuit is open (unless x.ai can hedge)
+    if not fast_mode and (HEDGING or llm_gateway.available("groq")):
+        try:
+            if TWO_STEP_ANALYSIS:
+                analysis = groq_handler.analyze_and_format(prompt, on_search_query, timeout=ANALYSIS_TIMEOUT)
+            else:
+                analysis = groq_handler.analyze_meme_quick(prompt, on_search_query, timeout=ANALYSIS_TIMEOUT)
+        except TimeoutError:
+            print(f"Analysis timed out after {ANALYSIS_TIMEOUT}s, using offline analyzer")
+    if not analysis:
+        # Degraded mode: keyword/template analysis so the user still gets a meme
+        analysis = analyze_offline(prompt)
+
+    # Step 2: Create the meme from the best candidates across all search queries
+    search_queries = analysis["search_queries"]
+    caption = analysis["captions"][0]
+    # A matching local template skips the search and download entirely
+    template = image_handler.match_template(search_queries)
+    image_urls = None if template else image_handler.search_all(search_queries, prefetched)
+    return analysis, image_handler.create_meme(search_queries[0], caption, image_urls, template)
 
 def generate_meme_response(prompt: str) -> str:
     """Generate a meme response using Groq for analysis and ImageHandler for creation."""
     try:
-        # Step 1: Analyze the meme request
-        analysis = groq_handler.analyze_meme_request(prompt)
+        # Fast mode skips the LLM: sidebar toggle or #fast in the prompt
+        fast_mode = st.session_state.get("fast_mode", False) or "#fast" in prompt.lower()
+
+        # Identical prompts submitted concurrently by other sessions share one pipeline run
+        analysis, meme_bytes = get_meme_flights().do(
+            (normalize_prompt(prompt), fast_mode), build_meme, prompt, fast_mode
+        )
         if not analysis:
             return "I couldn't understand what kind of meme you want. Try being more specific about the subject and what makes it funny!"
-            
-        # Step 2: Create the meme
-        search_query = analysis["search_queries"][0]  # Use first search query
-        caption = groq_handler.format_meme_text(analysis["captions"][0])  # Format first caption
-        
-        meme_bytes = image_handler.create_meme(search_query, caption)
+
         if meme_bytes:
             st.session_state.current_meme = meme_bytes
+            if analysis.get("offline"):
+                return f"Here's a quick meme about {analysis['subjects'][0]}! ⚡"
             return f"Here's your meme about {analysis['subjects'][0]}! 😎"
         else:
             return "I couldn't find a good image for your meme. Try a different subject or description!"
@@ -94,34 +281,58 @@ def generate_response(prompt: str, play_it_safe: bool = False) -> str:
         return random.choice(sarcastic_responses)
 
     # Use Grok for regular responses
-    API_KEY = st.secrets["groq_api_key"]
-    API_URL = "https://api.x.ai/v1/chat/completions"
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-
     system_message = """You are MemeGPT, a specialized AI that excels in creating memes and jokes. 
     Your responses should be creative, funny, and meme-worthy. Focus on generating humorous content 
     and meme suggestions."""
 
-    try:
-        response = requests.post(
-            API_URL,
-            headers=headers,
-            json={
-                "messages": [
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": prompt}
-                ],
-                "model": "grok-beta",
-                "stream": False,
-                "temperature": 0.7
-            }
+    # Recent turns within the token budget plus a running summary of older ones
+    memory: ConversationMemory = st.session_state.memory
+    history = st.session_state.messages or [{"role": "user", "content": prompt}]
+    memory.refresh(history, lambda summary, turns: groq_handler.summarize_conversation(
+        summary, turns, timeout=SUMMARY_TIMEOUT))
+    context = memory.context(history)
+
+    # The reply depends on the whole context; a first message keys on the prompt alone
+    cache_key = make_llm_key("grok-beta", system_message,
+                             prompt if len(context) == 1 else json.dumps(context), temperature=0.7)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    payload = {
+        "messages": [{"role": "system", "content": system_message}] + context,
+        "model": "grok-beta",
+        "stream": False,
+        "temperature": 0.7
+    }
+
+    async def ask(provider: str, model: str) -> str:
+        response = await llm_gateway.chat(provider, dict(payload, model=model))
+        content = response['choices'][0]['message']['content']
+        usage = response.get("usage") or {}
+        get_usage_tracker().record(
+            "chat",
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+            truncated=response['choices'][0].get("finish_reason") == "length"
         )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
+        return content
+
+    try:
+        if not llm_gateway.available("xai"):
+            # x.ai is marked unhealthy: answer from Groq instead of waiting on it
+            content = run_sync(ask("groq", get_model_router().primary_model("analysis")))
+        elif HEDGING:
+            # Duplicate to Groq if x.ai is slower than its recent latency percentile
+            content = run_sync(get_hedgers()["chat"].run(
+                lambda: ask("xai", "grok-beta"),
+                lambda: ask("groq", get_model_router().primary_model("analysis")),
+                is_valid=bool
+            ))
+        else:
+            content = run_sync(ask("xai", "grok-beta"))
+        llm_cache.set(cache_key, content)
+        return content
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         return "Sorry, I'm having trouble being creative right now. Try again!"
@@ -133,13 +344,61 @@ with st.sidebar:
         st.session_state.messages = []
         st.session_state.chat_history = []
         st.session_state.current_meme = None
+        st.session_state.memory = ConversationMemory(budget=st.session_state.memory.budget)
         st.experimental_rerun()
+
+    st.toggle("⚡ Fast mode", key="fast_mode", help="Skip the AI analysis and use quick offline templates")
     
     for chat in st.session_state.chat_history:
         with st.container():
             st.text(f"🕒 {chat['timestamp']}")
             st.text(f"💭 {chat['query'][:50]}...")
 
+    unhealthy = [name for name, state in breaker_states().items() if state["state"] != "closed"]
+    if unhealthy:
+        st.warning(f"Degraded: {', '.join(unhealthy)} unavailable")
+
+    with st.expander("⚙️ Diagnostics"):
+        st.caption("LLM response cache")
+        st.json(llm_cache.stats())
+        st.caption("Image search cache")
+        st.json(get_image_search_cache().stats())
+        st.caption("Similar prompt cache")
+        st.json(get_similarity_cache().stats())
+        st.caption("Analysis validation")
+        st.json(groq_handler.stats())
+        st.caption("LLM gateway")
+        st.json(llm_gateway.stats())
+        if HEDGING:
+            st.caption("Hedged requests")
+            st.json({name: hedger.stats() for name, hedger in get_hedgers().items()})
+        st.caption("Caption formatting paths")
+        st.json(get_caption_formatter().stats())
+        st.caption("Token usage")
+        st.json(dict(get_usage_tracker().stats(),
+                     this_session=get_usage_tracker().session_stats(st.session_state.session_id)))
+        st.caption("Conversation memory")
+        st.json(st.session_state.memory.stats(st.session_state.messages))
+        st.caption("Model routing")
+        st.json(get_model_router().stats())
+        if get_template_library() is not None:
+            st.caption("Meme templates")
+            st.json(get_template_library().stats())
+        st.caption("Downloaded image cache")
+        st.json(get_image_cache().stats())
+        st.caption("Image downloads")
+        st.json(download_engine.stats())
+        st.caption("Image download races")
+        st.json(race_stats())
+        st.caption("Circuit breakers")
+        st.json(breaker_states(include_closed=False))
+        st.caption("Request coalescing")
+        st.json({
+            "memes": get_meme_flights().stats(),
+            "searches": search_flights.stats(),
+            "downloads": download_flights.stats()
+        })
+
 # Main chat interface
 st.title("🤖 MemeGPT - Your Sarcastic Meme Companion")
 st.markdown("""
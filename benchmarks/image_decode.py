@@ -0,0 +1,98 @@
+"""Decode time and peak memory per image: full decode + thumbnail vs reduced decoding.
+
+Each measurement runs in a fresh subprocess, so peak RSS is not shared between
+images. Without arguments, synthetic photos are generated in a temp directory:
+
+    python benchmarks/image_decode.py
+    python benchmarks/image_decode.py photo1.jpg photo2.png --repeat 5
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from image_decode import MAX_SIZE, decode_image
+
+SYNTHETIC = [("photo_4000x3000.jpg", (4000, 3000), "JPEG"), ("photo_6000x4000.jpg", (6000, 4000), "JPEG"),
+             ("photo_1200x900.jpg", (1200, 900), "JPEG"), ("render_3000x2000.png", (3000, 2000), "PNG")]
+
+def peak_rss_mb() -> float:
+    # On Linux ru_maxrss survives exec (it would report the parent's peak), so read VmHWM
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def decode_full(content: bytes) -> Image.Image:
+    """The previous path: decode at full resolution, then thumbnail."""
+    image = Image.open(io.BytesIO(content))
+    image.load()
+    image.thumbnail(MAX_SIZE, Image.LANCZOS)
+    return image
+
+def measure(path: str, mode: str, repeat: int) -> dict:
+    with open(path, "rb") as f:
+        content = f.read()
+    decode = decode_full if mode == "full" else lambda data: decode_image(data)[0]
+    baseline = peak_rss_mb()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = decode(content)
+        times.append(time.perf_counter() - start)
+    return {"ms": 1000 * min(times), "peak_mb": peak_rss_mb() - baseline, "size": list(image.size)}
+
+def generate(directory: str) -> list:
+    paths = []
+    for name, size, fmt in SYNTHETIC:
+        # Smooth gradients with a little texture compress like real photos
+        image = Image.linear_gradient("L").resize(size).convert("RGB")
+        image = Image.merge("RGB", (image.getchannel(0), image.getchannel(0).rotate(90),
+                                    Image.effect_noise(size, 40)))
+        path = os.path.join(directory, name)
+        image.save(path, fmt, quality=90)
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="image files (default: generated synthetic photos)")
+    parser.add_argument("--repeat", type=int, default=3, help="decodes per measurement (best time is reported)")
+    parser.add_argument("--child", nargs=2, metavar=("PATH", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child[0], args.child[1], args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.images or generate(directory)
+        print(f"{'image':<28} {'source':>11} {'mode':<8} {'decode ms':>10} {'peak RSS MB':>12}")
+        for path in paths:
+            with Image.open(path) as image:
+                source = f"{image.width}x{image.height}"
+            for mode in ("full", "reduced"):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", path, mode, "--repeat", str(args.repeat)],
+                    capture_output=True, text=True, check=True
+                ).stdout
+                result = json.loads(output)
+                print(f"{os.path.basename(path):<28} {source:>11} {mode:<8} {result['ms']:>10.1f} "
+                      f"{result['peak_mb']:>12.1f}")
+
+if __name__ == "__main__":
+    main()
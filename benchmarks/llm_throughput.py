@@ -0,0 +1,95 @@
+"""End-to-end LLM throughput benchmark against the local mock server.
+
+Drives GroqHandler (analysis path) and the x.ai chat path through the real
+gateway, rate limiter and router, with no API keys or network access:
+
+    python benchmarks/llm_throughput.py --requests 200 --concurrency 20
+    python benchmarks/llm_throughput.py --base-url http://127.0.0.1:8008/v1  # external mock
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_runner import run_sync
+from groq_handler import GroqHandler
+from llm_gateway import LLMGateway, ProviderConfig
+from mock_llm_server import MockConfig, serve
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else 0.0
+
+async def run_load(handler: GroqHandler, gateway: LLMGateway, mode: str, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        prompt = f"meme about topic number {i} #play-it-safe"
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                if mode == "quick":
+                    result = await handler.analyze_meme_quick_async(prompt)
+                elif mode == "stream":
+                    result = await handler.analyze_meme_quick_async(prompt, on_search_query=lambda query: None)
+                elif mode == "two-step":
+                    result = await handler.analyze_and_format_async(prompt)
+                else:
+                    response = await gateway.chat("xai", {
+                        "model": "grok-beta",
+                        "messages": [{"role": "user", "content": prompt}],
+                        "temperature": 0.7
+                    })
+                    result = response["choices"][0]["message"]["content"]
+            except Exception:
+                result = None
+            if result:
+                latencies.append(time.monotonic() - start)
+            else:
+                failures += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.monotonic() - start, latencies, failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["quick", "stream", "two-step", "chat"], default="quick")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--base-url", help="use an already running mock server instead of an in-process one")
+    parser.add_argument("--latency-median", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=int, help="client-side rate limit per model")
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None:
+        server = serve(MockConfig(port=0, latency_median=args.latency_median, error_rate=args.error_rate,
+                                  rate_limit_rate=args.rate_limit_rate, seed=1))
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    providers = {
+        name: ProviderConfig(base_url, "mock-key", max_concurrency=args.concurrency,
+                             requests_per_minute=args.requests_per_minute)
+        for name in ("groq", "xai")
+    }
+    gateway = LLMGateway(providers)
+    handler = GroqHandler(gateway)  # no caches: every request reaches the server
+
+    elapsed, latencies, failures = run_sync(run_load(handler, gateway, args.mode, args.requests, args.concurrency))
+    print(f"mode={args.mode} requests={args.requests} concurrency={args.concurrency} base_url={base_url}")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s over {elapsed:.2f}s, failures: {failures}")
+    print(f"latency p50={percentile(latencies, 0.5):.3f}s p95={percentile(latencies, 0.95):.3f}s "
+          f"p99={percentile(latencies, 0.99):.3f}s")
+    print(f"gateway: {gateway.stats()}")
+    print(f"router: {handler.router.stats()['models']}")
+
+if __name__ == "__main__":
+    main()
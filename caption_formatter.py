@@ -0,0 +1,89 @@
+import re
+import threading
+from typing import Dict, Tuple
+
+FILLER_WORDS = {"basically", "literally", "actually", "just", "really", "very", "totally", "simply", "um", "uh"}
+LABEL_PATTERN = re.compile(r"^\s*(caption|text|meme text|top text|bottom text)\s*:\s*", re.IGNORECASE)
+DESCRIPTION_PATTERN = re.compile(
+    r"^\s*(an? )?(image|picture|photo|meme|gif) (of|about|showing|with)\b|^\s*(show|display|describe)\b",
+    re.IGNORECASE
+)
+def _strip_label(text: str) -> str:
+    """Remove surrounding quotes and a leading "Caption:"-style label (and the quotes after it)."""
+    text = LABEL_PATTERN.sub("", text.strip().strip("\"'")).strip()
+    return text.strip("\"'").strip()
+
+BREAK_PATTERN = re.compile(r"(?<=[,;:.!?])\s+|\s+[-–—]\s+")
+
+class LocalCaptionFormatter:
+    """Deterministic caption formatter that replaces the LLM for simple captions.
+
+    Handles casing, filler words, punctuation, length limits and the split into
+    top/bottom lines ("TOP\\nBOTTOM"). needs_rewrite() decides when a caption is
+    not a caption yet (too long, several sentences, a scene description) and
+    should go to the LLM instead.
+    """
+
+    def __init__(self, max_line_chars: int = 32, max_chars: int = 80, max_words: int = 18):
+        self.max_line_chars = max_line_chars
+        self.max_chars = max_chars
+        self.max_words = max_words
+        self._lock = threading.Lock()
+        # local: formatted here; llm: rewritten by the LLM; cached: an earlier LLM
+        # rewrite from the response cache; fallback: LLM failed, raw text formatted here
+        self.counts = {"local": 0, "llm": 0, "cached": 0, "fallback": 0}
+
+    def needs_rewrite(self, text: str) -> bool:
+        """True when the caption needs the LLM rather than mechanical cleanup."""
+        cleaned = _strip_label(text)
+        if not cleaned:
+            return True
+        sentences = [part for part in re.split(r"[.!?]+\s+", cleaned) if part.strip()]
+        return (
+            len(cleaned.split()) > self.max_words
+            or len(sentences) > 2
+            or DESCRIPTION_PATTERN.search(cleaned) is not None
+        )
+
+    def count(self, path: str):
+        """Count a caption formatted by path ("local", "llm", "cached" or "fallback")."""
+        with self._lock:
+            self.counts[path] += 1
+
+    def format(self, text: str) -> str:
+        """Clean, upper-case and split a caption into "TOP\\nBOTTOM" (or a single line)."""
+        text = _strip_label(" ".join(text.split()))
+        words = [word for word in text.split() if word.lower().strip(",.!?") not in FILLER_WORDS]
+        text = " ".join(words)
+        text = re.sub(r"([!?.,])\1+", r"\1", text)  # "!!!" -> "!"
+        text = re.sub(r"\s+([,.!?;:])", r"\1", text)
+        text = text.rstrip(".,;:").upper()
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars].rsplit(" ", 1)[0].rstrip(",;:-")
+        top, bottom = self.split(text)
+        return f"{top}\n{bottom}" if top else bottom
+
+    def split(self, text: str) -> Tuple[str, str]:
+        """Split a caption into (top, bottom); top is empty for short captions."""
+        if len(text) <= self.max_line_chars:
+            return "", text
+        middle = len(text) / 2
+        breaks = [match for match in BREAK_PATTERN.finditer(text) if 0 < match.start() < len(text) - 1]
+        if breaks:
+            match = min(breaks, key=lambda m: abs(m.start() - middle))
+            top, bottom = text[:match.start()], text[match.end():]
+            if abs(len(top) - len(bottom)) < len(text) * 0.6:
+                return top.rstrip(",;:-– —"), bottom
+        spaces = [i for i, char in enumerate(text) if char == " "]
+        if not spaces:
+            return "", text
+        cut = min(spaces, key=lambda i: abs(i - middle))
+        return text[:cut], text[cut + 1:]
+
+    def stats(self) -> Dict[str, int]:
+        """Return how many captions took each path."""
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        counts["local_rate"] = round(counts["local"] / total, 3) if total else 0.0
+        return counts
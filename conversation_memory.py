@@ -0,0 +1,86 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD = 4
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """Rough token count of chat messages: characters / 4 plus a per-message overhead."""
+    return sum(len(message.get("content") or "") // 4 + MESSAGE_OVERHEAD for message in messages)
+
+class ConversationMemory:
+    """Sliding-window chat memory bounded by an estimated token budget.
+
+    Recent messages are sent verbatim while they fit in budget tokens. When the
+    window overflows, the oldest messages are dropped until it is back under
+    low_water * budget and folded into a running summary. Only the previous
+    summary and the dropped messages are summarized, and thanks to the low-water
+    mark that happens every few turns instead of on every turn.
+    """
+
+    def __init__(self, budget: int = 1500, low_water: float = 0.6):
+        self.budget = budget
+        self.low_water = low_water
+        self.summary = ""
+        self.summarized = 0  # number of leading messages folded into the summary
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self._lock = threading.Lock()
+
+    def _overflow(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Return the oldest window messages that must leave it (the newest always stays)."""
+        window = messages[self.summarized:]
+        if estimate_tokens(window) <= self.budget:
+            return []
+        tokens = estimate_tokens(window)
+        count = 0
+        while count < len(window) - 1 and tokens > self.budget * self.low_water:
+            tokens -= estimate_tokens(window[count:count + 1])
+            count += 1
+        return window[:count]
+
+    def refresh(self, messages: List[Dict[str, str]],
+                summarize: Callable[[str, List[Dict[str, str]]], Optional[str]]):
+        """Fold messages that no longer fit the window into the summary.
+
+        summarize(summary, messages) returns the updated summary. If it fails the
+        messages are dropped anyway, so the prompt stays within the budget.
+        """
+        with self._lock:
+            if len(messages) < self.summarized:  # history was cleared
+                self.summary, self.summarized = "", 0
+            turns = self._overflow(messages)
+            if not turns:
+                return
+            summary = None
+            try:
+                summary = summarize(self.summary, turns)
+            except Exception as e:
+                print(f"Error summarizing conversation: {str(e)}")
+            if summary:
+                self.summary = summary.strip()
+                self.refreshes += 1
+            else:
+                self.failed_refreshes += 1
+            self.summarized += len(turns)
+
+    def context(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Return the chat messages to send: the running summary, then the window."""
+        context = []
+        if self.summary:
+            context.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+        context.extend({"role": message["role"], "content": message["content"]}
+                       for message in messages[self.summarized:])
+        return context
+
+    def stats(self, messages: List[Dict[str, str]]) -> Dict[str, int]:
+        """Return window and summary sizes for the given history."""
+        return {
+            "messages": len(messages),
+            "summarized_messages": self.summarized,
+            "window_tokens": estimate_tokens(messages[self.summarized:]),
+            "summary_tokens": len(self.summary) // 4,
+            "budget": self.budget,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes
+        }
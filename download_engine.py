@@ -0,0 +1,182 @@
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# Leading bytes of the image formats we decode (see image_decode.ACCEPTED_FORMATS)
+SIGNATURES = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+SNIFF_BYTES = 12
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Return the image format named by the magic bytes at the start of data, or None."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    for signature, name in SIGNATURES:
+        if data.startswith(signature):
+            return name
+    return None
+
+class DownloadError(Exception):
+    """A download was refused or failed; reason is a short machine-readable tag."""
+
+    def __init__(self, url: str, reason: str, message: str = "", status: Optional[int] = None):
+        super().__init__(f"{reason}: {message or url}")
+        self.url = url
+        self.reason = reason
+        self.status = status
+
+    @property
+    def host_failure(self) -> bool:
+        """True when the host itself looks unhealthy (as opposed to a bad URL or file)."""
+        return self.reason in ("connect", "timeout", "deadline") or (self.status or 0) >= 500
+
+class DownloadEngine:
+    """Pooled, bounded HTTP downloads of image files.
+
+    One keep-alive requests session is shared by all threads. Each host gets
+    at most per_host concurrent downloads. Calls have separate connect and read
+    timeouts plus an overall deadline that covers the wait for a host slot,
+    connecting and the headers (the timeouts are capped to the time left) and
+    the body (the response is aborted if it is still streaming when time runs out).
+    Bodies are capped at max_bytes (rejected up front when Content-Length is
+    larger), and anything whose first bytes are not an accepted image format
+    is rejected before the rest is read.
+    """
+
+    def __init__(self, connect_timeout: float = 3.05, read_timeout: float = 10.0, deadline: float = 15.0,
+                 max_bytes: int = 10 * 1024 * 1024, per_host: int = 4, pool_size: int = 32,
+                 chunk_size: int = 64 * 1024):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.per_host = per_host
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"User-Agent": "Mozilla/5.0 (compatible; ChatMeme/1.0)",
+                                     "Accept": "image/jpeg,image/png,image/gif,image/webp;q=0.9"})
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, threading.BoundedSemaphore] = {}
+        self._stats = {"downloads": 0, "bytes": 0, "in_flight": 0}
+        self._errors: Dict[str, int] = defaultdict(int)
+
+    def _host_slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            slot = self._hosts.get(host)
+            if slot is None:
+                slot = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def fetch(self, url: str) -> bytes:
+        """Download an image file and return its bytes; raises DownloadError."""
+        try:
+            return self._fetch(url)
+        except DownloadError as e:
+            with self._lock:
+                self._errors[e.reason] += 1
+            raise
+
+    def _fetch(self, url: str) -> bytes:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise DownloadError(url, "bad_url")
+        deadline = time.monotonic() + self.deadline
+        slot = self._host_slot(parts.hostname)
+        if not slot.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise DownloadError(url, "host_busy", f"no free slot for {parts.hostname}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            slot.release()
+            raise DownloadError(url, "deadline", f"over {self.deadline}s waiting for {parts.hostname}")
+        with self._lock:
+            self._stats["in_flight"] += 1
+        expired = threading.Event()
+        watchdog = None
+        try:
+            # Connecting and waiting for the headers also come out of the remaining time
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            with self.session.get(url, stream=True, timeout=timeout) as response:
+                # A slow trickle never trips the read timeout, so the watchdog aborts it
+                watchdog = threading.Timer(max(0.0, deadline - time.monotonic()), self._abort,
+                                           (response, expired))
+                watchdog.daemon = True
+                watchdog.start()
+                if response.status_code >= 400:
+                    raise DownloadError(url, "http_status", f"HTTP {response.status_code}", response.status_code)
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > self.max_bytes:
+                    raise DownloadError(url, "too_large", f"Content-Length {length}")
+                body = bytearray()
+                sniffed = False
+                for chunk in response.iter_content(self.chunk_size):
+                    body.extend(chunk)
+                    if not sniffed and len(body) >= SNIFF_BYTES:
+                        self._sniff(url, body, response)
+                        sniffed = True
+                    if len(body) > self.max_bytes:
+                        raise DownloadError(url, "too_large", f"over {self.max_bytes} bytes")
+                if expired.is_set():
+                    raise DownloadError(url, "deadline", f"over {self.deadline}s")
+                if not sniffed:
+                    self._sniff(url, body, response)
+        except DownloadError:
+            raise
+        except Exception as e:
+            if expired.is_set():
+                raise DownloadError(url, "deadline", f"over {self.deadline}s")
+            if isinstance(e, requests.Timeout):
+                raise DownloadError(url, "timeout", str(e))
+            if isinstance(e, requests.ConnectionError):
+                raise DownloadError(url, "connect", str(e))
+            if isinstance(e, requests.RequestException):
+                raise DownloadError(url, "request", str(e))
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            slot.release()
+            with self._lock:
+                self._stats["in_flight"] -= 1
+        with self._lock:
+            self._stats["downloads"] += 1
+            self._stats["bytes"] += len(body)
+        return bytes(body)
+
+    @staticmethod
+    def _abort(response: requests.Response, expired: threading.Event):
+        """Unblock a read in progress: shut the socket down, then close the response."""
+        expired.set()
+        # urllib3/http.client keep the socket in private attributes; without one,
+        # the deadline still applies as soon as the blocked read returns
+        sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+        if sock is None:
+            fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+            sock = getattr(getattr(fp, "raw", None), "_sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        response.close()
+
+    @staticmethod
+    def _sniff(url: str, body: bytearray, response: requests.Response):
+        if sniff_image_format(bytes(body[:SNIFF_BYTES])) is None:
+            raise DownloadError(url, "not_image", response.headers.get("content-type") or "unknown content")
+
+    def stats(self) -> Dict[str, object]:
+        """Return download counters and rejections/failures by reason."""
+        with self._lock:
+            return dict(self._stats, errors=dict(self._errors))
@@ -1,15 +1,25 @@
-from groq import Groq
-from typing import Dict, Optional
+from typing import Any, Callable, Dict, List, Optional
+import asyncio
 import json
+import time
+from async_runner import run_sync
+from caption_formatter import LocalCaptionFormatter
+from disk_cache import DiskCache, make_llm_key
+from hedging import Hedger
+from llm_gateway import GatewayError, LLMGateway, ProviderUnavailableError
+from model_router import ModelRouter, is_decommissioned
+from json_stream import IncrementalJSONParser, JSONEvent, extract_json_object
+from similarity_cache import SimilarityCache
+from token_usage import UsageTracker
 
-class GroqHandler:
-    def __init__(self, api_key: str):
-        self.client = Groq(api_key=api_key)
-        self.model = "mixtral-8x7b-32768"  # Using stable model
+# Expected type of each analysis field; every field must be non-empty
+ANALYSIS_SCHEMA = {"subjects": list, "search_queries": list, "captions": list}
+QUICK_ANALYSIS_SCHEMA = {"subject": str, "search_queries": list, "caption": str}
 
-    def analyze_meme_request(self, prompt: str) -> Optional[Dict]:
-        """Analyze the meme request and generate search queries."""
-        system_prompt = """You are a meme analysis expert. Given a meme request, extract:
+# Most search queries kept from a quick analysis; each one is searched in parallel
+MAX_QUICK_SEARCH_QUERIES = 3
+
+ANALYSIS_PROMPT = """You are a meme analysis expert. Given a meme request, extract:
         1. Main subjects/topics
         2. Image search queries
         3. Captions or text to add
@@ -22,48 +32,478 @@ class GroqHandler:
         }
         Each list must contain at least one item. Do not include any other text or explanation."""
 
-        try:
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
-            content = completion.choices[0].message.content.strip()
-            
-            # Validate JSON structure
+QUICK_ANALYSIS_PROMPT = """You are a meme expert. Given a meme request, return ONLY this JSON object:
+        {"subject": "main subject", "search_queries": ["image search terms", "alternative search terms"],
+         "caption": "punchy meme caption"}
+        Give 2 or 3 different search queries, best first. The caption must be short (max 12 words)
+        and ready to print on the image. No other text."""
+
+FORMAT_PROMPT = "You are a meme text formatter. Make the text punchy and meme-worthy."
+
+BATCH_FORMAT_PROMPT = """You are a meme text formatter. Make each text punchy and meme-worthy.
+        You receive a JSON list of texts. Return ONLY a JSON object in this format:
+        {"captions": ["formatted text 1", "formatted text 2"]}
+        with exactly one caption per input text, in the same order."""
+
+SUMMARY_PROMPT = """You keep a running summary of a chat between a user and MemeGPT, a meme bot.
+        You receive the current summary and the turns that follow it. Return ONLY the updated summary,
+        at most 120 words, keeping names, preferences, running jokes and unfinished requests."""
+
+REPAIR_PROMPT = """You complete partial meme analyses. Given a meme request and a partial JSON analysis,
+        return ONLY a JSON object containing the single missing field, in this format:
+        {example}"""
+
+# Call types whose reply length scales with the input, so one cap per call type does not fit
+UNCAPPED_CALL_TYPES = {"format_batch"}
+
+def _invalid_fields(data: Dict, schema: Dict[str, type]) -> List[str]:
+    """Return the schema fields that are missing, mistyped or empty.
+
+    List fields must hold only non-empty strings.
+    """
+    invalid = []
+    for field, field_type in schema.items():
+        value = data.get(field)
+        if not isinstance(value, field_type) or not value or (field_type is str and not value.strip()):
+            invalid.append(field)
+        elif field_type is list and not all(isinstance(item, str) and item.strip() for item in value):
+            invalid.append(field)
+    return invalid
+
+def _normalize_analysis(data: Dict, schema: Dict[str, type]) -> Dict:
+    """Convert a validated reply to the {subjects, search_queries, captions} structure."""
+    if schema is QUICK_ANALYSIS_SCHEMA:
+        return {
+            "subjects": [data["subject"].strip()],
+            "search_queries": [query.strip() for query in data["search_queries"][:MAX_QUICK_SEARCH_QUERIES]],
+            "captions": [data["caption"].strip()]
+        }
+    return data
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+def _search_query_hook(on_search_query: Callable[[str], None]) -> Callable[[JSONEvent], None]:
+    """Build a stream hook that reports the first complete search query once."""
+    fired = False
+
+    def on_value(event: JSONEvent):
+        nonlocal fired
+        key, index, value = event
+        if fired or not isinstance(value, str) or not value.strip():
+            return
+        if key == "search_queries" and index == 0:
+            fired = True
+            on_search_query(value.strip())
+
+    return on_value
+
+class GroqHandler:
+    def __init__(self, gateway: LLMGateway, cache: Optional[DiskCache] = None,
+                 similarity_cache: Optional[SimilarityCache] = None, router: Optional[ModelRouter] = None,
+                 hedger: Optional[Hedger] = None, hedge_provider: str = "xai", hedge_model: str = "grok-beta",
+                 usage: Optional[UsageTracker] = None, local_formatter: Optional[LocalCaptionFormatter] = None):
+        self.gateway = gateway
+        self.provider = "groq"
+        self.router = router or ModelRouter()  # picks the model per call type
+        # Optional: duplicate slow analysis calls to a second provider
+        self.hedger = hedger
+        self.hedge_provider = hedge_provider
+        self.hedge_model = hedge_model
+        self.usage = usage  # token accounting and adaptive max_tokens
+        self.local_formatter = local_formatter  # rule-based fast path for simple captions
+        self.cache = cache
+        self.similarity_cache = similarity_cache
+        self.analysis_stats = {
+            "responses": 0,
+            "invalid": 0,
+            "repairs": 0,
+            "repaired": 0,
+            "repair_tokens_saved": 0  # estimated completion tokens not spent on full retries
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """Return analysis validation and repair counters."""
+        stats = dict(self.analysis_stats)
+        stats["invalid_rate"] = round(stats["invalid"] / stats["responses"], 3) if stats["responses"] else 0.0
+        return stats
+
+    def _cache_key(self, call_type: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                   temperature: float) -> Optional[str]:
+        if self.cache is None:
+            return None
+        model = self.router.primary_model(call_type)
+        return make_llm_key(model, system_prompt, user_prompt, temperature=temperature, max_tokens=max_tokens)
+
+    async def _cache_get(self, key: Optional[str]) -> Optional[Any]:
+        return None if key is None else await asyncio.to_thread(self.cache.get, key)
+
+    async def _cache_set(self, key: Optional[str], value: Any):
+        if key is not None:
+            await asyncio.to_thread(self.cache.set, key, value)
+
+    async def _complete(self, call_type: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                        temperature: float = 0.7) -> str:
+        """Run a single chat completion and return the reply text, using the response cache."""
+        key = self._cache_key(call_type, system_prompt, user_prompt, max_tokens, temperature)
+        content = await self._cache_get(key)
+        if content is None:
+            content = await self._request(call_type, system_prompt, user_prompt, max_tokens, temperature)
+            await self._cache_set(key, content)
+        return content
+
+    async def _request(self, call_type: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                       temperature: float, on_value: Optional[Callable[[JSONEvent], None]] = None,
+                       json_mode: bool = False) -> str:
+        """Send the request, hedging analysis calls to the secondary provider when enabled.
+
+        Both hedged replies feed the same on_value hook, so the first search query
+        seen may come from the reply that loses; callers must not rely on it.
+        max_tokens is the nominal budget; the usage tracker may lower it to the
+        adaptive cap for the call type (except for UNCAPPED_CALL_TYPES).
+        """
+        if self.usage is not None and call_type not in UNCAPPED_CALL_TYPES:
+            max_tokens = self.usage.max_tokens(call_type, max_tokens)
+        if call_type not in ("analysis", "quick_analysis") or self.hedger is None:
+            return await self._request_routed(call_type, system_prompt, user_prompt, max_tokens, temperature,
+                                              on_value, json_mode)
+
+        async def secondary() -> str:
+            parser = IncrementalJSONParser() if on_value is not None else None
+            return await self._send(call_type, self.hedge_model, system_prompt, user_prompt, max_tokens, temperature,
+                                    parser, on_value, False, provider=self.hedge_provider)
+
+        return await self.hedger.run(
+            lambda: self._request_routed(call_type, system_prompt, user_prompt, max_tokens, temperature,
+                                         on_value, json_mode),
+            secondary,
+            is_valid=lambda content: extract_json_object(content) is not None
+        )
+
+    async def _request_routed(self, call_type: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                              temperature: float, on_value: Optional[Callable[[JSONEvent], None]] = None,
+                              json_mode: bool = False) -> str:
+        """Send the request to the routed model, failing over to the next model on errors.
+
+        Failover stops once a streamed reply has started, so on_value never sees
+        values from two different replies, and when the provider's circuit is
+        open, since every model would be rejected the same way.
+        """
+        error = None
+        for model in self.router.candidates(call_type):
+            parser = IncrementalJSONParser() if on_value is not None else None
+            start = time.monotonic()
             try:
-                data = json.loads(content)
-                if not all(key in data for key in ["subjects", "search_queries", "captions"]):
-                    raise ValueError("Missing required fields in response")
-                if not all(isinstance(data[key], list) and len(data[key]) > 0 for key in ["subjects", "search_queries", "captions"]):
-                    raise ValueError("Empty or invalid lists in response")
-                return data
-            except (json.JSONDecodeError, ValueError) as e:
-                print(f"Invalid response format: {str(e)}\nResponse: {content}")
-                return None
-                
+                content = await self._send(call_type, model, system_prompt, user_prompt, max_tokens, temperature,
+                                           parser, on_value, json_mode)
+            except ProviderUnavailableError:
+                raise
+            except GatewayError as e:
+                error = e
+                if is_decommissioned(e.status, e.body):
+                    self.router.mark_decommissioned(model)
+                else:
+                    self.router.record(model, time.monotonic() - start, ok=False)
+                    if e.status is not None and e.status < 500 and e.status != 429:
+                        raise  # a bad request fails the same way on every model
+                if parser is not None and parser.buffer:
+                    raise
+                print(f"Model {model} failed for {call_type}: {str(e)}")
+                continue
+            self.router.record(model, time.monotonic() - start, ok=True)
+            return content
+        raise error or GatewayError(self.provider, f"no model available for {call_type}")
+
+    async def _send(self, call_type: str, model: str, system_prompt: str, user_prompt: str, max_tokens: int,
+                    temperature: float, parser: Optional[IncrementalJSONParser],
+                    on_value: Optional[Callable[[JSONEvent], None]], json_mode: bool,
+                    provider: Optional[str] = None) -> str:
+        """Send one completion request through the gateway, streaming when a parser is given.
+
+        json_mode asks the API for a JSON object; Groq does not support JSON mode
+        together with streaming, so streamed replies rely on extraction instead.
+        """
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        if parser is None:
+            if json_mode:
+                payload["response_format"] = {"type": "json_object"}
+            data = await self.gateway.chat(provider or self.provider, payload)
+            content = data["choices"][0]["message"]["content"].strip()
+            self._record_usage(call_type, payload, content, data.get("usage"), data["choices"][0].get("finish_reason"))
+            return content
+
+        meta = {}
+        async for delta in self.gateway.stream_chat(provider or self.provider, payload, meta):
+            for event in parser.feed(delta):
+                on_value(event)
+        content = parser.buffer.strip()
+        self._record_usage(call_type, payload, content, meta.get("usage"), meta.get("finish_reason"))
+        return content
+
+    def _record_usage(self, call_type: str, payload: Dict, content: str, usage: Optional[Dict],
+                      finish_reason: Optional[str]):
+        """Record API usage, estimating from text length when the provider sent none."""
+        if self.usage is None:
+            return
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or sum(
+            _estimate_tokens(message["content"]) for message in payload["messages"]
+        )
+        completion_tokens = usage.get("completion_tokens") or _estimate_tokens(content)
+        self.usage.record(call_type, prompt_tokens, completion_tokens, truncated=finish_reason == "length")
+
+    async def _repair(self, prompt: str, data: Dict, field: str, field_type: type) -> Optional[Any]:
+        """Ask for a single missing field of an otherwise valid analysis."""
+        example = json.dumps({field: ["..."] if field_type is list else "..."})
+        partial = json.dumps({key: value for key, value in data.items() if key != field})
+        content = await self._request(
+            "repair",
+            REPAIR_PROMPT.format(example=example),
+            f"Meme request: {prompt}\nPartial analysis: {partial}",
+            max_tokens=100,
+            temperature=0.3,
+            json_mode=True
+        )
+        repaired = extract_json_object(content) or {}
+        if _invalid_fields(repaired, {field: field_type}):
+            return None
+        return repaired[field]
+
+    async def _validate_or_repair(self, prompt: str, content: str, schema: Dict[str, type]) -> Optional[Dict]:
+        """Extract the analysis object and repair it when exactly one field is bad."""
+        self.analysis_stats["responses"] += 1
+        data = extract_json_object(content)
+        invalid = list(schema) if data is None else _invalid_fields(data, schema)
+        if not invalid:
+            return data
+
+        self.analysis_stats["invalid"] += 1
+        if data is None or len(invalid) > 1:
+            print(f"Invalid response format: bad fields {invalid}\nResponse: {content}")
+            return None
+
+        field = invalid[0]
+        self.analysis_stats["repairs"] += 1
+        value = await self._repair(prompt, data, field, schema[field])
+        if value is None:
+            print(f"Could not repair field '{field}'\nResponse: {content}")
+            return None
+        self.analysis_stats["repaired"] += 1
+        self.analysis_stats["repair_tokens_saved"] += max(0, _estimate_tokens(content) - _estimate_tokens(json.dumps(value)))
+        data[field] = value
+        return data
+
+    async def analyze_meme_request_async(self, prompt: str,
+                                         on_search_query: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+        """Analyze the meme request and generate search queries.
+
+        If on_search_query is given the reply is streamed and the callback fires
+        with the first search query while the captions are still being generated.
+        The callback runs on the event loop thread and must not block.
+        """
+        return await self._analyze("analysis", ANALYSIS_PROMPT, prompt, 500, ANALYSIS_SCHEMA, on_search_query)
+
+    async def analyze_meme_quick_async(self, prompt: str,
+                                       on_search_query: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+        """Analyze the meme request and write the final caption in a single call.
+
+        Returns the same structure as analyze_meme_request, with up to
+        MAX_QUICK_SEARCH_QUERIES search queries but a single subject and a caption
+        that is already formatted for display. on_search_query
+        behaves as in analyze_meme_request_async.
+        """
+        return await self._analyze("quick_analysis", QUICK_ANALYSIS_PROMPT, prompt, 160, QUICK_ANALYSIS_SCHEMA,
+                                   on_search_query)
+
+    async def _analyze(self, call_type: str, system_prompt: str, prompt: str, max_tokens: int,
+                       schema: Dict[str, type], on_search_query: Optional[Callable[[str], None]]) -> Optional[Dict]:
+        """Shared analysis path: similarity cache, response cache, then the API with repair."""
+        if self.similarity_cache is not None:
+            analysis = self.similarity_cache.get(prompt, namespace=system_prompt)
+            if analysis is not None:
+                if on_search_query:
+                    on_search_query(analysis["search_queries"][0])
+                return analysis
+
+        on_value = _search_query_hook(on_search_query) if on_search_query else None
+        key = self._cache_key(call_type, system_prompt, prompt, max_tokens, 0.7)
+        try:
+            data = None
+            content = await self._cache_get(key)
+            if content is not None:
+                data = extract_json_object(content)
+                if data is not None and _invalid_fields(data, schema):
+                    data = None
+                elif data is not None and on_value is not None:
+                    for event in IncrementalJSONParser().feed(content):
+                        on_value(event)
+            if data is None:
+                content = await self._request(call_type, system_prompt, prompt, max_tokens, 0.7, on_value,
+                                              json_mode=True)
+                data = await self._validate_or_repair(prompt, content, schema)
+                if data is None:
+                    return None
+                await self._cache_set(key, json.dumps(data))
         except Exception as e:
             print(f"Error analyzing meme request: {str(e)}")
             return None
 
-    def format_meme_text(self, text: str) -> str:
-        """Format text for meme display."""
+        analysis = _normalize_analysis(data, schema)
+        if self.similarity_cache is not None:
+            self.similarity_cache.add(prompt, analysis, namespace=system_prompt)
+        return analysis
+
+    async def format_meme_text_async(self, text: str) -> str:
+        """Format text for meme display.
+
+        With a local formatter, simple captions are formatted locally and the LLM
+        is only asked when the caption needs rewriting.
+        """
+        if self.local_formatter is not None and not self.local_formatter.needs_rewrite(text):
+            self.local_formatter.count("local")
+            return self.local_formatter.format(text)
+        key = self._cache_key("format", FORMAT_PROMPT, text, 100, 0.7)
+        formatted = await self._cache_get(key)
+        if formatted is not None:
+            return self._finish_caption(formatted, "cached")
         try:
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a meme text formatter. Make the text punchy and meme-worthy."},
-                    {"role": "user", "content": text}
-                ],
-                temperature=0.7,
-                max_tokens=100
-            )
-            return completion.choices[0].message.content
+            formatted = await self._request("format", FORMAT_PROMPT, text, 100, 0.7)
         except Exception as e:
             print(f"Error formatting meme text: {str(e)}")
+            return self._finish_caption(text, "fallback")
+        await self._cache_set(key, formatted)
+        return self._finish_caption(formatted)
+
+    def _finish_caption(self, text: str, path: str = "llm") -> str:
+        """Apply the local casing/splitting rules to an LLM-formatted caption.
+
+        path records where the text came from: "llm", "cached" (an earlier LLM
+        reply) or "fallback" (the raw text after a failed call).
+        """
+        if self.local_formatter is None:
             return text
+        self.local_formatter.count(path)
+        return self.local_formatter.format(text)
+
+    async def format_meme_texts_async(self, texts: List[str]) -> List[str]:
+        """Format a list of texts in one completion, preserving order.
+
+        Texts the local formatter can handle and texts already in the response
+        cache are not sent. If the batch reply does not contain exactly one
+        caption per text, the texts are formatted one by one (concurrently).
+        """
+        results: List[Optional[str]] = [None] * len(texts)
+        rewrite = []
+        for i, text in enumerate(texts):
+            if self.local_formatter is not None and not self.local_formatter.needs_rewrite(text):
+                self.local_formatter.count("local")
+                results[i] = self.local_formatter.format(text)
+            else:
+                rewrite.append(i)
+
+        keys = {i: self._cache_key("format", FORMAT_PROMPT, texts[i], 100, 0.7) for i in rewrite}
+        cached = await asyncio.gather(*(self._cache_get(keys[i]) for i in rewrite))
+        missing = []
+        for i, content in zip(rewrite, cached):
+            if content is None:
+                missing.append(i)
+            else:
+                results[i] = self._finish_caption(content, "cached")
+
+        if len(missing) == 1:
+            results[missing[0]] = await self.format_meme_text_async(texts[missing[0]])
+        elif missing:
+            batch = [texts[i] for i in missing]
+            captions = None
+            try:
+                content = await self._request("format_batch", BATCH_FORMAT_PROMPT, json.dumps(batch),
+                                              max_tokens=60 * len(batch) + 20, temperature=0.7, json_mode=True)
+                captions = (extract_json_object(content) or {}).get("captions")
+            except Exception as e:
+                print(f"Error formatting meme texts: {str(e)}")
+            if (isinstance(captions, list) and len(captions) == len(batch)
+                    and all(isinstance(caption, str) and caption.strip() for caption in captions)):
+                for i, caption in zip(missing, captions):
+                    await self._cache_set(keys[i], caption.strip())
+                    results[i] = self._finish_caption(caption.strip())
+            else:
+                print(f"Batch formatting returned {len(captions) if isinstance(captions, list) else 'no'} "
+                      f"captions for {len(batch)} texts, formatting one by one")
+                formatted = await asyncio.gather(*(self.format_meme_text_async(texts[i]) for i in missing))
+                for i, caption in zip(missing, formatted):
+                    results[i] = caption
+        return results
+
+    async def format_captions_async(self, analysis: Dict) -> List[str]:
+        """Format every caption of an analysis in one batched call, preserving order."""
+        return await self.format_meme_texts_async(analysis["captions"])
+
+    async def analyze_and_format_async(self, prompt: str,
+                                       on_search_query: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+        """Run the two-step path: full analysis, then format all captions in one batch."""
+        analysis = await self.analyze_meme_request_async(prompt, on_search_query)
+        if analysis:
+            analysis["captions"] = await self.format_captions_async(analysis)
+        return analysis
+
+    async def summarize_conversation_async(self, summary: str, turns: List[Dict[str, str]]) -> str:
+        """Extend a running conversation summary with the given turns."""
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        return await self._complete(
+            "summary",
+            SUMMARY_PROMPT,
+            f"Current summary: {summary or '(none)'}\n\nNew turns:\n{transcript}",
+            max_tokens=200,
+            temperature=0.3
+        )
+
+    # Sync wrappers for the Streamlit script thread
+
+    def analyze_meme_request(self, prompt: str,
+                             on_search_query: Optional[Callable[[str], None]] = None) -> Optional[Dict]:
+        """Analyze the meme request and generate search queries."""
+        return run_sync(self.analyze_meme_request_async(prompt, on_search_query))
+
+    def analyze_meme_quick(self, prompt: str, on_search_query: Optional[Callable[[str], None]] = None,
+                           timeout: Optional[float] = None) -> Optional[Dict]:
+        """Analyze the meme request and write the final caption in a single call.
+
+        Raises TimeoutError if no analysis is ready within timeout seconds.
+        """
+        return run_sync(self.analyze_meme_quick_async(prompt, on_search_query), timeout)
+
+    def format_meme_text(self, text: str) -> str:
+        """Format text for meme display."""
+        return run_sync(self.format_meme_text_async(text))
+
+    def format_meme_texts(self, texts: List[str]) -> List[str]:
+        """Format a list of texts in one completion, preserving order."""
+        return run_sync(self.format_meme_texts_async(texts))
+
+    def format_captions(self, analysis: Dict) -> List[str]:
+        """Format every caption of an analysis in one batched call."""
+        return run_sync(self.format_captions_async(analysis))
+
+    def summarize_conversation(self, summary: str, turns: List[Dict[str, str]],
+                               timeout: Optional[float] = None) -> str:
+        """Extend a running conversation summary with the given turns.
+
+        Raises TimeoutError if the summary is not ready within timeout seconds.
+        """
+        return run_sync(self.summarize_conversation_async(summary, turns), timeout)
+
+    def analyze_and_format(self, prompt: str, on_search_query: Optional[Callable[[str], None]] = None,
+                           timeout: Optional[float] = None) -> Optional[Dict]:
+        """Run the two-step path with batched caption formatting.
+
+        Raises TimeoutError if no analysis is ready within timeout seconds.
+        """
+        return run_sync(self.analyze_and_format_async(prompt, on_search_query), timeout)
@@ -0,0 +1,94 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+class Hedger:
+    """Races a duplicate request against a slow primary.
+
+    The primary call starts alone. If it has not finished by the deadline (the
+    given percentile of recent primary latencies, clamped to min/max_delay) or it
+    fails, the secondary call is started too. The first valid result wins and
+    the other call is cancelled.
+    """
+
+    def __init__(self, percentile: float = 0.9, min_delay: float = 0.5, max_delay: float = 10.0,
+                 default_delay: float = 3.0, window: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self.calls = 0
+        self.fired = 0
+        self.secondary_wins = 0
+        self.primary_wins_after_hedge = 0
+
+    def deadline(self) -> float:
+        """Seconds to wait for the primary before hedging."""
+        if len(self._latencies) < self.min_samples:
+            return self.default_delay
+        ordered = sorted(self._latencies)
+        value = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return min(self.max_delay, max(self.min_delay, value))
+
+    async def run(self, primary: Callable[[], Awaitable[T]], secondary: Callable[[], Awaitable[T]],
+                  is_valid: Optional[Callable[[T], bool]] = None) -> T:
+        """Return the first valid result of primary() or (after the deadline) secondary().
+
+        A primary that is cancelled before finishing (it lost, or run() itself
+        was cancelled) is sampled with its elapsed time, a lower bound of its real
+        latency, so slow primaries keep the deadline up.
+        """
+        is_valid = is_valid or (lambda result: result is not None)
+        self.calls += 1
+        start = time.monotonic()
+        primary_task = asyncio.ensure_future(primary())
+        primary_task.add_done_callback(
+            lambda task: None if task.cancelled() or task.exception() else
+            self._latencies.append(time.monotonic() - start)
+        )
+        secondary_task = None
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.deadline())
+            if done and not primary_task.exception() and is_valid(primary_task.result()):
+                return primary_task.result()
+
+            self.fired += 1
+            secondary_task = asyncio.ensure_future(secondary())
+            pending = {secondary_task} if done else {primary_task, secondary_task}
+            error: Optional[BaseException] = primary_task.exception() if done else None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                    elif is_valid(task.result()):
+                        if task is secondary_task:
+                            self.secondary_wins += 1
+                        else:
+                            self.primary_wins_after_hedge += 1
+                        return task.result()
+            if error is not None:
+                raise error
+            return primary_task.result() if not primary_task.cancelled() else secondary_task.result()
+        finally:
+            if not primary_task.done():
+                self._latencies.append(time.monotonic() - start)
+                primary_task.cancel()
+            if secondary_task is not None and not secondary_task.done():
+                secondary_task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return how often the hedge fired and which side won."""
+        return {
+            "calls": self.calls,
+            "hedged": self.fired,
+            "hedge_rate": round(self.fired / self.calls, 3) if self.calls else 0.0,
+            "secondary_won": self.secondary_wins,
+            "primary_won_after_hedge": self.primary_wins_after_hedge,
+            "deadline_s": round(self.deadline(), 3)
+        }
@@ -0,0 +1,29 @@
+import io
+from typing import Tuple
+from PIL import Image
+
+# Only these PIL plugins may decode downloaded data
+ACCEPTED_FORMATS = ("JPEG", "PNG", "GIF", "WEBP")
+
+# Largest meme image we render, and the largest source image we agree to decode
+MAX_SIZE = (800, 800)
+MAX_PIXELS = 50_000_000
+
+def decode_image(content: bytes, max_size: Tuple[int, int] = MAX_SIZE) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Decode image data to fit within max_size; returns (image, original size).
+
+    JPEGs are decoded straight at a reduced DCT scale (draft mode), so a large
+    photo is never materialized at full resolution. Other formats are reduced
+    right after decoding. Raises for unaccepted formats and oversized images.
+    """
+    image = Image.open(io.BytesIO(content), formats=ACCEPTED_FORMATS)
+    size = image.size
+    if size[0] * size[1] > MAX_PIXELS:
+        raise Image.DecompressionBombError(f"image too large: {size[0]}x{size[1]}")
+    ratio = min(1.0, max_size[0] / size[0], max_size[1] / size[1])
+    if image.format == "JPEG" and ratio < 1.0:
+        image.draft("RGB", (max(1, int(size[0] * ratio)), max(1, int(size[1] * ratio))))
+    image.load()
+    # Uses Image.reduce() for the bulk of large downscales before resampling
+    image.thumbnail(max_size, Image.LANCZOS)
+    return image, size
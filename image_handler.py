@@ -1,64 +1,248 @@
 from PIL import Image, ImageDraw, ImageFont
 import io
 import os
+import threading
 from typing import List, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 from duckduckgo_search import DDGS
-import requests
-from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from circuit_breaker import CircuitOpenError, get_breaker
+from disk_cache import DiskCache, normalize_prompt
+from download_engine import DownloadEngine, DownloadError
+from image_decode import MAX_SIZE, decode_image
+from image_index import PerceptualImageCache
+from singleflight import SingleFlight
+from template_library import Box, MemeTemplate, TemplateLibrary
+
+# Shared by all handler instances so prefetches survive Streamlit reruns
+_search_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-search")
+_download_executor = ThreadPoolExecutor(max_workers=12, thread_name_prefix="image-download")
+
+# Smallest width/height a downloaded image needs to be used for a meme
+MIN_IMAGE_SIDE = 100
+
+# Reciprocal rank fusion constant for merging results of several queries
+RRF_K = 10
+
+# Searches that found nothing are cached briefly so a transient empty result is retried soon
+EMPTY_SEARCH_TTL = 600
+
+def merge_ranked(results: List[List[str]]) -> List[str]:
+    """Merge ranked URL lists with reciprocal rank fusion.
+
+    A URL found by several queries ranks higher; ties go to the earlier query.
+    """
+    scores: Dict[str, float] = {}
+    for urls in results:
+        for rank, url in enumerate(urls):
+            scores[url] = scores.get(url, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=lambda url: -scores[url])
+
+# How download races went: which search rank won, and how often no candidate worked.
+# Updated from concurrent session threads, so always under _race_lock.
+_race_stats = {"races": 0, "failed": 0, "cancelled": 0, "wins_by_rank": {}}
+_race_lock = threading.Lock()
+
+def race_stats() -> Dict[str, object]:
+    """Return a copy of the download race counters."""
+    with _race_lock:
+        return dict(_race_stats, wins_by_rank=dict(_race_stats["wins_by_rank"]))
+
+# Process-wide coalescing of identical in-flight searches and downloads across sessions
+search_flights = SingleFlight()
+download_flights = SingleFlight()
+
+# Pooled, size-capped image downloads shared by all sessions
+download_engine = DownloadEngine()
+
+# Process-wide circuit breakers: one for the search API, one per image host
+search_breaker = get_breaker("image_search", failure_threshold=3, reset_timeout=60.0)
+
+def download_breaker(url: str):
+    return get_breaker(f"download:{urlsplit(url).hostname}", failure_threshold=3, reset_timeout=120.0)
 
 class ImageHandler:
-    def __init__(self):
+    def __init__(self, search_cache: Optional[DiskCache] = None, candidates: int = 3,
+                 templates: Optional[TemplateLibrary] = None, image_cache: Optional[PerceptualImageCache] = None):
         self.ddgs = DDGS()
+        self.image_cache = image_cache  # downloaded images, deduplicated by perceptual hash
+        self.templates = templates  # local meme templates that skip search and download
+        self.candidates = candidates  # image URLs downloaded concurrently per meme
         self.cache_dir = "cache"
         self._setup_cache_dir()
+        # Optional process-wide search result cache shared by all sessions
+        self.search_cache = search_cache
         
     def _setup_cache_dir(self):
         """Setup cache directory for storing processed images."""
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-    @lru_cache(maxsize=100)
     def search_images(self, query: str, num_images: int = 1) -> List[str]:
         """Search for images using DuckDuckGo."""
         try:
-            results = list(self.ddgs.images(
-                query,
-                max_results=num_images,
-                type="photo"
-            ))
-            return [result["image"] for result in results] if results else []
+            return list(self._cached_search(query, num_images))
         except Exception as e:
             print(f"Error searching images: {str(e)}")
             return []
 
+    def _cached_search(self, query: str, num_images: int) -> List[str]:
+        """Serve the search from the cache, including from results of a larger earlier search.
+
+        Entries store the URLs and how many were requested, so a short result list
+        also answers any smaller request. Failures raise and are not cached; empty
+        results only for EMPTY_SEARCH_TTL seconds.
+        """
+        key = normalize_prompt(query)
+        if self.search_cache is not None:
+            entry = self.search_cache.get(key)
+            if entry is not None and entry["requested"] >= num_images:
+                return entry["urls"][:num_images]
+        urls = search_flights.do((key, num_images), self._search_images, query, num_images)
+        if self.search_cache is not None:
+            # Concurrent searches may finish out of order; keep the larger result
+            entry = self.search_cache.peek(key)
+            if entry is None or entry["requested"] < num_images:
+                self.search_cache.set(key, {"urls": urls, "requested": num_images},
+                                      ttl=None if urls else EMPTY_SEARCH_TTL)
+        return urls
+
+    def _search_images(self, query: str, num_images: int) -> List[str]:
+        results = list(search_breaker.call(
+            self.ddgs.images,
+            query,
+            max_results=num_images,
+            type="photo"
+        ))
+        return [result["image"] for result in results] if results else []
+
+    def prefetch_search(self, query: str, num_images: Optional[int] = None) -> Future:
+        """Start an image search in the background and return its future."""
+        return _search_executor.submit(self.search_images, query, num_images or self.candidates)
+
+    def match_template(self, queries: List[str]) -> Optional[MemeTemplate]:
+        """Return the first local template matching one of the queries, if any."""
+        if self.templates is None:
+            return None
+        for query in queries:
+            template = self.templates.match(str(query))
+            if template is not None:
+                return template
+        return None
+
+    def search_all(self, queries: List[str], searches: Optional[Dict[str, Future]] = None) -> List[str]:
+        """Search all queries concurrently and merge them into one ranked candidate list.
+
+        searches maps queries to already running searches (e.g. prefetches), which are reused.
+        """
+        searches = dict(searches or {})
+        ordered = []
+        for query in queries:
+            query = str(query).strip()
+            if query and normalize_prompt(query) not in map(normalize_prompt, ordered):
+                ordered.append(query)
+                if query not in searches:
+                    searches[query] = self.prefetch_search(query)
+        return merge_ranked([searches[query].result() for query in ordered])
+
     def download_image(self, url: str) -> Optional[Image.Image]:
         """Download and open an image from URL."""
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            return Image.open(io.BytesIO(response.content))
+            # Concurrent downloads of the same URL share one request; each caller decodes its own copy
+            content = download_flights.do(url, self._fetch, url)
+            return decode_image(content)[0]
         except Exception as e:
             print(f"Error downloading image: {str(e)}")
             return None
 
+    def _download_usable(self, url: str) -> Optional[Image.Image]:
+        """Download and decode an image at meme size; None if it is broken or too small.
+
+        With an image cache, the image is stored there and the largest cached
+        copy of the same picture is returned.
+        """
+        try:
+            content = download_flights.do(url, self._fetch, url)
+            image, size = decode_image(content)
+            if min(size) < MIN_IMAGE_SIDE:
+                return None
+            if self.image_cache is not None:
+                larger = self.image_cache.add(url, image, content, size)
+                if larger is not None:
+                    image = decode_image(larger)[0]
+            return image
+        except Exception as e:
+            print(f"Error downloading image: {str(e)}")
+            return None
+
+    def download_first(self, urls: List[str]) -> Optional[Image.Image]:
+        """Download all candidate URLs concurrently and return the first usable image.
+
+        Downloads that have not started yet are cancelled once a winner is found;
+        running ones finish in the background and are discarded.
+        """
+        if not urls:
+            return None
+        # URLs whose picture is already cached need no download at all
+        if self.image_cache is not None:
+            for url in urls:
+                content = self.image_cache.get(url)
+                if content is not None:
+                    try:
+                        return decode_image(content)[0]
+                    except Exception as e:
+                        print(f"Error decoding cached image: {str(e)}")
+        with _race_lock:
+            _race_stats["races"] += 1
+        futures = {_download_executor.submit(self._download_usable, url): rank for rank, url in enumerate(urls)}
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image = future.result()
+                    if image is not None:
+                        rank = futures[future]
+                        with _race_lock:
+                            _race_stats["wins_by_rank"][rank] = _race_stats["wins_by_rank"].get(rank, 0) + 1
+                        return image
+        finally:
+            cancelled = sum(future.cancel() for future in pending)
+            with _race_lock:
+                _race_stats["cancelled"] += cancelled
+        with _race_lock:
+            _race_stats["failed"] += 1
+        return None
+
+    @staticmethod
+    def _fetch(url: str) -> bytes:
+        breaker = download_breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        try:
+            content = download_engine.fetch(url)
+        except DownloadError as e:
+            # A 4xx, an oversized file or an HTML page is a problem with this URL, not with the host
+            if e.host_failure:
+                breaker.record_failure(e)
+            else:
+                breaker.record_success()
+            raise
+        breaker.record_success()
+        return content
+
     def add_text_to_image(self, image: Image.Image, text: str, position: str = "bottom") -> Image.Image:
         """Add text to image at specified position."""
         try:
             # Create a copy of the image
             img = image.copy()
             draw = ImageDraw.Draw(img)
-            
-            # Calculate font size based on image size
+            image_width, image_height = img.size
+
+            # Calculate font size based on image size, shrinking until the text fits
             font_size = int(min(img.size) * 0.08)  # 8% of smallest dimension
-            try:
-                font = ImageFont.truetype("arial.ttf", font_size)
-            except:
-                font = ImageFont.load_default()
+            font, font_size, text_width, text_height = self._fit_font(draw, text, font_size, image_width * 0.95)
 
-            # Calculate text size and position
-            text_width, text_height = draw.textsize(text, font=font)
-            image_width, image_height = img.size
-            
             # Position text
             if position == "top":
                 x = (image_width - text_width) // 2
@@ -77,26 +261,86 @@ class ImageHandler:
             print(f"Error adding text to image: {str(e)}")
             return image
 
-    def create_meme(self, search_query: str, caption: str) -> Optional[bytes]:
-        """Create a meme from search query and caption."""
+    @staticmethod
+    def _fit_font(draw: ImageDraw.ImageDraw, text: str, font_size: int, max_width: float,
+                  max_height: Optional[float] = None) -> Tuple[ImageFont.ImageFont, int, int, int]:
+        """Shrink the font from font_size until text fits; returns (font, size, width, height)."""
+        while True:
+            try:
+                font = ImageFont.truetype("arial.ttf", font_size)
+            except OSError:
+                font = ImageFont.load_default(size=font_size)
+            left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+            text_width, text_height = right - left, bottom - top
+            fits = text_width <= max_width and (max_height is None or text_height <= max_height)
+            if fits or font_size <= 12:
+                return font, font_size, text_width, text_height
+            font_size = int(font_size * 0.9)
+
+    def add_text_in_box(self, image: Image.Image, text: str, box: Box) -> Image.Image:
+        """Add text centered in a template caption box (fractions of the image size)."""
         try:
-            # Search for image
-            image_urls = self.search_images(search_query)
-            if not image_urls:
-                return None
+            img = image.copy()
+            draw = ImageDraw.Draw(img)
+            image_width, image_height = img.size
+            left, top = box[0] * image_width, box[1] * image_height
+            box_width, box_height = (box[2] - box[0]) * image_width, (box[3] - box[1]) * image_height
 
-            # Download first image
-            image = self.download_image(image_urls[0])
-            if not image:
-                return None
+            font_size = max(12, int(min(box_height * 0.6, min(img.size) * 0.08)))
+            font, font_size, text_width, text_height = self._fit_font(draw, text, font_size, box_width * 0.95,
+                                                                       box_height * 0.9)
+            x = left + (box_width - text_width) / 2
+            y = top + (box_height - text_height) / 2
 
-            # Resize image if too large
-            max_size = (800, 800)
-            if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-                image.thumbnail(max_size, Image.LANCZOS)
+            shadow_offset = max(1, font_size // 20)
+            draw.text((x + shadow_offset, y + shadow_offset), text, font=font, fill="black")
+            draw.text((x, y), text, font=font, fill="white")
+            return img
+        except Exception as e:
+            print(f"Error adding text to image: {str(e)}")
+            return image
+
+    def create_meme(self, search_query: str, caption: str, image_urls: Optional[List[str]] = None,
+                    template: Optional[MemeTemplate] = None) -> Optional[bytes]:
+        """Create a meme from search query and caption.
+
+        image_urls can be passed in when the search was already run (e.g. prefetched).
+        A local template (given, or matching the search query when no URLs are
+        given) is used instead of searching and downloading.
+        """
+        try:
+            if template is None and image_urls is None:
+                template = self.match_template([search_query])
+            if template is not None:
+                image = self.templates.load_image(template)
+            else:
+                # Search for candidate images
+                if image_urls is None:
+                    image_urls = self.search_images(search_query, self.candidates)
+                if not image_urls:
+                    return None
 
-            # Add caption
-            meme = self.add_text_to_image(image, caption)
+                # Race the top candidates; the first usable download wins
+                image = self.download_first(image_urls[:self.candidates])
+                if not image:
+                    return None
+
+            # Resize image if too large (downloads and templates are already decoded at this size)
+            if image.size[0] > MAX_SIZE[0] or image.size[1] > MAX_SIZE[1]:
+                image.thumbnail(MAX_SIZE, Image.LANCZOS)
+
+            # Add caption ("TOP\nBOTTOM" puts the first line at the top)
+            lines = [line for line in caption.split("\n") if line.strip()] or [caption]
+            if template is not None:
+                meme = image
+                for text, box in zip(self._box_texts(lines, len(template.boxes)), template.boxes):
+                    if text:
+                        meme = self.add_text_in_box(meme, text, box)
+            elif len(lines) > 1:
+                meme = self.add_text_to_image(image, lines[0], "top")
+                meme = self.add_text_to_image(meme, " ".join(lines[1:]), "bottom")
+            else:
+                meme = self.add_text_to_image(image, lines[0])
 
             # Convert to bytes
             img_byte_arr = io.BytesIO()
@@ -107,3 +351,10 @@ class ImageHandler:
         except Exception as e:
             print(f"Error creating meme: {str(e)}")
             return None
+
+    @staticmethod
+    def _box_texts(lines: List[str], boxes: int) -> List[str]:
+        """Spread caption lines over the caption boxes; with fewer lines, the last boxes get them."""
+        if len(lines) >= boxes:
+            return lines[:boxes - 1] + [" ".join(lines[boxes - 1:])]
+        return [""] * (boxes - len(lines)) + lines
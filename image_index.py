@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8  # 8x8 grid -> 64-bit hashes
+
+def _reduce(image: Image.Image, width: int, height: int) -> np.ndarray:
+    return np.asarray(image.convert("L").resize((width, height), Image.BILINEAR), dtype=np.float32)
+
+def ahash(image: Image.Image, size: int = HASH_SIZE) -> int:
+    """Average hash: which cells of a size x size grayscale thumbnail are brighter than the mean."""
+    pixels = _reduce(image, size, size)
+    return _pack(pixels > pixels.mean())
+
+def dhash(image: Image.Image, size: int = HASH_SIZE) -> int:
+    """Difference hash: whether each pixel is brighter than its right neighbour."""
+    pixels = _reduce(image, size + 1, size)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+def _distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Hamming distances between an array of uint64 hashes and one hash."""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+class PerceptualImageCache:
+    """Disk cache of downloaded images, deduplicated by perceptual hash.
+
+    Every stored image gets a dHash and an aHash. An image within max_distance
+    bits of a cached one on both hashes is the same picture: only the copy with
+    the most pixels is kept, and all URLs that led to it map to it. get(url)
+    returns the cached file for any URL seen before, so it is not downloaded
+    again. Files live in directory, the index in an SQLite database next to them.
+    """
+
+    def __init__(self, directory: str = os.path.join("cache", "images"), max_distance: int = 6,
+                 max_entries: int = 500):
+        self.directory = directory
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._stats = {"url_hits": 0, "misses": 0, "stored": 0, "duplicates": 0, "upgraded": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "dhash TEXT PRIMARY KEY, ahash TEXT NOT NULL, path TEXT NOT NULL, "
+            "width INTEGER NOT NULL, height INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, dhash TEXT NOT NULL)")
+        self._conn.commit()
+        self._load_hashes()
+
+    def _load_hashes(self):
+        # In-memory copy of the hash columns for vectorized near-duplicate search
+        rows = self._conn.execute("SELECT dhash, ahash FROM images").fetchall()
+        self._keys = [row[0] for row in rows]
+        self._dhashes = np.array([int(row[0], 16) for row in rows], dtype=np.uint64)
+        self._ahashes = np.array([int(row[1], 16) for row in rows], dtype=np.uint64)
+
+    def _find_duplicate(self, d: int, a: int) -> Optional[str]:
+        if not self._keys:
+            return None
+        distance = np.maximum(_distances(self._dhashes, d), _distances(self._ahashes, a))
+        best = int(distance.argmin())
+        return self._keys[best] if distance[best] <= self.max_distance else None
+
+    def get(self, url: str) -> Optional[bytes]:
+        """Return the cached file for a URL seen before, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT images.dhash, images.path FROM urls JOIN images ON urls.dhash = images.dhash "
+                "WHERE urls.url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["url_hits"] += 1
+            self._conn.execute("UPDATE images SET last_access = ? WHERE dhash = ?", (time.time(), row[0]))
+            self._conn.commit()
+        return self._read(row[1])
+
+    def add(self, url: str, image: Image.Image, content: bytes,
+            size: Optional[Tuple[int, int]] = None) -> Optional[bytes]:
+        """Store a downloaded image; returns the file of a larger cached copy of it, if any.
+
+        content is the downloaded file, stored as is to avoid re-encoding. size is
+        the pixel size of that file when image is a reduced decode of it.
+        """
+        d, a = dhash(image), ahash(image)
+        width, height = size or image.size
+        now = time.time()
+        with self._lock:
+            key = self._find_duplicate(d, a)
+            if key is None:
+                key = f"{d:016x}"
+                path = os.path.join(self.directory, f"{key}.img")
+                self._write(path, content)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO images (dhash, ahash, path, width, height, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (key, f"{a:016x}", path, width, height, now)
+                )
+                self._conn.execute("INSERT OR REPLACE INTO urls (url, dhash) VALUES (?, ?)", (url, key))
+                self._stats["stored"] += 1
+                if key in self._keys:  # same dHash re-stored after its row was replaced
+                    self._ahashes[self._keys.index(key)] = np.uint64(a)
+                else:
+                    self._keys.append(key)
+                    self._dhashes = np.append(self._dhashes, np.uint64(d))
+                    self._ahashes = np.append(self._ahashes, np.uint64(a))
+                if self._evict():
+                    self._load_hashes()
+                self._conn.commit()
+                return None
+
+            self._stats["duplicates"] += 1
+            path, cached_width, cached_height = self._conn.execute(
+                "SELECT path, width, height FROM images WHERE dhash = ?", (key,)
+            ).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO urls (url, dhash) VALUES (?, ?)", (url, key))
+            larger = width * height > cached_width * cached_height
+            if larger:
+                self._write(path, content)
+                self._conn.execute("UPDATE images SET width = ?, height = ?, last_access = ? WHERE dhash = ?",
+                                   (width, height, now, key))
+                self._stats["upgraded"] += 1
+            else:
+                self._conn.execute("UPDATE images SET last_access = ? WHERE dhash = ?", (now, key))
+            self._conn.commit()
+        # A larger copy is already cached; use it instead of the one just downloaded
+        return None if larger else self._read(path)
+
+    @staticmethod
+    def _read(path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _write(path: str, content: bytes):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def _evict(self) -> bool:
+        """Drop least recently used images beyond max_entries; True if any were dropped (caller holds the lock)."""
+        excess = len(self._keys) - self.max_entries
+        if excess <= 0:
+            return False
+        rows = self._conn.execute(
+            "SELECT dhash, path FROM images ORDER BY last_access LIMIT ?", (excess,)
+        ).fetchall()
+        for key, path in rows:
+            self._conn.execute("DELETE FROM images WHERE dhash = ?", (key,))
+            self._conn.execute("DELETE FROM urls WHERE dhash = ?", (key,))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._stats["evictions"] += len(rows)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            images = self._conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            urls = self._conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+        return dict(self._stats, images=images, urls=urls)
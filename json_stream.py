@@ -0,0 +1,136 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# (top-level key, array index or None, decoded value)
+JSONEvent = Tuple[str, Optional[int], Any]
+
+class IncrementalJSONParser:
+    """Incremental parser for a streamed JSON object.
+
+    Feed text chunks as they arrive; feed() returns an event for every value that
+    has just been completed: each element of a top-level array as soon as it
+    closes, and each top-level value (including whole arrays) once it ends.
+    Text before the first "{" (e.g. a code fence) is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._in_literal = False
+        self._expect_key = False
+        self._key_start = None
+        self._key: Optional[str] = None
+        self._value_starts = {}  # depth -> start index of the value being parsed
+        self._index = 0
+
+    def feed(self, chunk: str) -> List[JSONEvent]:
+        """Consume a chunk of text and return the values it completed."""
+        self.buffer += chunk
+        events: List[JSONEvent] = []
+        buf = self.buffer
+        for i in range(self._pos, len(buf)):
+            if self.done:
+                break
+            c = buf[i]
+            if not self._stack:
+                if c == "{":
+                    self._stack.append(c)
+                    self._expect_key = True
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = self._decode(self._key_start, i + 1)
+                        self._key_start = None
+                    else:
+                        self._end_value(len(self._stack), i + 1, events)
+                continue
+
+            if c == '"':
+                self._in_string = True
+                if len(self._stack) == 1 and self._expect_key:
+                    self._key_start = i
+                else:
+                    self._start_value(i)
+            elif c in "{[":
+                self._start_value(i)
+                if len(self._stack) == 1 and c == "[":
+                    self._index = 0
+                self._stack.append(c)
+            elif c in "}]":
+                self._end_literal(i, events)
+                self._stack.pop()
+                if not self._stack:
+                    self.done = True
+                else:
+                    self._end_value(len(self._stack), i + 1, events)
+            elif c == ",":
+                self._end_literal(i, events)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+            elif c == ":":
+                if len(self._stack) == 1:
+                    self._expect_key = False
+            elif c.isspace():
+                self._end_literal(i, events)
+            elif not self._in_literal:
+                self._in_literal = True
+                self._start_value(i)
+        self._pos = len(buf)
+        return events
+
+    def _tracked(self, depth: int) -> bool:
+        if depth == 1:
+            return not self._expect_key
+        return depth == 2 and self._stack[1] == "["
+
+    def _start_value(self, i: int):
+        depth = len(self._stack)
+        if self._tracked(depth) and depth not in self._value_starts:
+            self._value_starts[depth] = i
+
+    def _end_literal(self, i: int, events: List[JSONEvent]):
+        if self._in_literal:
+            self._in_literal = False
+            self._end_value(len(self._stack), i, events)
+
+    def _end_value(self, depth: int, end: int, events: List[JSONEvent]):
+        start = self._value_starts.pop(depth, None)
+        if start is None or self._key is None:
+            return
+        value = self._decode(start, end)
+        if depth == 1:
+            events.append((self._key, None, value))
+        else:
+            events.append((self._key, self._index, value))
+            self._index += 1
+
+    def _decode(self, start: int, end: int) -> Any:
+        try:
+            return json.loads(self.buffer[start:end])
+        except json.JSONDecodeError:
+            return None
+
+def extract_json_object(text: str) -> Optional[Dict]:
+    """Return the first JSON object embedded in text (e.g. inside a code fence or prose)."""
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            value, _ = decoder.raw_decode(text, start)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            pass
+        start = text.find("{", start + 1)
+    return None
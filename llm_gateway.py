@@ -0,0 +1,279 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+import httpx
+from circuit_breaker import CircuitBreaker, get_breaker
+from rate_limiter import RateLimiter, parse_retry_after
+
+@dataclass
+class ProviderConfig:
+    """Connection settings for one OpenAI-compatible chat completions provider."""
+    base_url: str
+    api_key: str
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    max_retries: int = 2
+    max_concurrency: int = 8
+    requests_per_minute: Optional[int] = None  # quotas apply per model, as Groq enforces them
+    tokens_per_minute: Optional[int] = None
+    # Per-model overrides: model -> {"requests_per_minute": ..., "tokens_per_minute": ...}
+    model_limits: Dict[str, Dict[str, int]] = field(default_factory=dict)
+    max_queue_time: float = 60.0  # how long 429-throttled work keeps waiting before failing
+    breaker_failures: int = 5  # consecutive failed calls that open the provider's circuit
+    breaker_reset: float = 30.0  # seconds before a half-open probe call is let through
+    breaker_slow_call: float = 5.0  # a call cancelled after this long on the wire counts as failed
+
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+XAI_BASE_URL = "https://api.x.ai/v1"
+
+# Retried with backoff; other 4xx responses are returned to the caller at once.
+# 429 is handled separately: the provider queue pauses for Retry-After.
+RETRY_STATUSES = {408, 500, 502, 503, 504}
+DEFAULT_RETRY_AFTER = 2.0
+
+class GatewayError(Exception):
+    """A provider call failed; status is the HTTP status (None for transport errors)."""
+
+    def __init__(self, provider: str, message: str, status: Optional[int] = None, body: str = ""):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.status = status
+        self.body = body
+
+class ProviderUnavailableError(GatewayError):
+    """The provider's circuit is open, so the call was rejected without being sent."""
+
+    def __init__(self, provider: str):
+        super().__init__(provider, "circuit open, provider marked unhealthy")
+
+def estimate_tokens(payload: Dict[str, Any]) -> int:
+    """Rough token estimate of a request: prompt characters / 4 plus the completion budget."""
+    prompt_chars = sum(len(message.get("content") or "") for message in payload.get("messages", []))
+    return prompt_chars // 4 + int(payload.get("max_tokens") or 256)
+
+class LLMGateway:
+    """Single entry point for all LLM calls (Groq and x.ai).
+
+    Each provider gets one pooled keep-alive httpx client living on the shared
+    background loop, so TLS handshakes are paid once per process rather than per
+    message. Calls get per-provider timeouts, retries with jittered backoff and
+    a concurrency limit, and are admitted by a RateLimiter per (provider, model)
+    so bursts queue up near each model's quota instead of failing with 429. A process-wide circuit
+    breaker per provider rejects calls at once while the provider is down.
+    """
+
+    def __init__(self, providers: Dict[str, ProviderConfig]):
+        self.providers = providers
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.limiters: Dict[Tuple[str, str], RateLimiter] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {
+            name: get_breaker(f"llm:{name}", failure_threshold=config.breaker_failures,
+                              reset_timeout=config.breaker_reset)
+            for name, config in providers.items()
+        }
+        self._stats = {name: {"requests": 0, "retries": 0, "errors": 0, "in_flight": 0} for name in providers}
+
+    def _client(self, provider: str) -> httpx.AsyncClient:
+        client = self._clients.get(provider)
+        if client is None:
+            config = self.providers[provider]
+            client = httpx.AsyncClient(
+                base_url=config.base_url,
+                headers={"Authorization": f"Bearer {config.api_key}", "Content-Type": "application/json"},
+                timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=config.max_concurrency,
+                    max_keepalive_connections=config.max_concurrency
+                )
+            )
+            self._clients[provider] = client
+            self._semaphores[provider] = asyncio.Semaphore(config.max_concurrency)
+        return client
+
+    def _limiter(self, provider: str, model: Optional[str]) -> RateLimiter:
+        """Return the rate limiter for the model, created on first use from the provider's quotas."""
+        key = (provider, model or "")
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            config = self.providers[provider]
+            limits = config.model_limits.get(model or "", {})
+            limiter = RateLimiter(limits.get("requests_per_minute", config.requests_per_minute),
+                                  limits.get("tokens_per_minute", config.tokens_per_minute))
+            self.limiters[key] = limiter
+        return limiter
+
+    def available(self, provider: str) -> bool:
+        """Return False while the provider's circuit is open."""
+        return not self.breakers[provider].is_open()
+
+    def _admit(self, provider: str):
+        if not self.breakers[provider].allow():
+            raise ProviderUnavailableError(provider)
+
+    def _settle(self, provider: str, error: Optional[GatewayError] = None):
+        """Report a finished call to the breaker; client errors mean the provider is up."""
+        if error is None or (error.status is not None and error.status < 500 and error.status not in (408, 429)):
+            self.breakers[provider].record_success()
+        else:
+            self.breakers[provider].record_failure(error)
+
+    def _settle_cancelled(self, provider: str, error: Optional[GatewayError], sent_at: Optional[float]):
+        """Report a cancelled call (e.g. the caller's deadline ran out).
+
+        It counts as a failure when the request had been waiting on the provider
+        for breaker_slow_call seconds or an earlier attempt had already failed, so
+        a hanging provider still opens its circuit when callers give up first.
+        """
+        waited = time.monotonic() - sent_at if sent_at is not None else 0.0
+        if error is not None or waited >= self.providers[provider].breaker_slow_call:
+            self.breakers[provider].record_failure(error or GatewayError(provider, f"cancelled after {waited:.1f}s"))
+
+    async def _should_retry(self, provider: str, limiter: RateLimiter, error: GatewayError, attempt: int,
+                            started: float, retry_after: Optional[str] = None) -> bool:
+        """Wait as needed and return True if the failed call should be sent again.
+
+        429s re-queue the call behind a provider-wide pause until max_queue_time
+        runs out (the pause applies to the model's limiter); other retryable
+        failures use up one of max_retries attempts.
+        """
+        config = self.providers[provider]
+        if error.status == 429:
+            if time.monotonic() - started >= config.max_queue_time:
+                return False
+            delay = parse_retry_after(retry_after)
+            limiter.pause(DEFAULT_RETRY_AFTER if delay is None else delay)
+            return True
+        if (error.status is not None and error.status not in RETRY_STATUSES) or attempt >= config.max_retries:
+            return False
+        self._stats[provider]["retries"] += 1
+        await asyncio.sleep(0.5 * (2 ** attempt) * (0.5 + random.random()))
+        return True
+
+    async def chat(self, provider: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a chat completion and return the decoded JSON response."""
+        client = self._client(provider)
+        limiter = self._limiter(provider, payload.get("model"))
+        stats = self._stats[provider]
+        estimate = estimate_tokens(payload)
+        self._admit(provider)
+        started = time.monotonic()
+        attempt = 0
+        error = None
+        sent_at = None
+        try:
+            while True:
+                await limiter.acquire(estimate)
+                retry_after = None
+                async with self._semaphores[provider]:
+                    stats["requests"] += 1
+                    stats["in_flight"] += 1
+                    sent_at = time.monotonic()
+                    try:
+                        response = await client.post("/chat/completions", json=payload)
+                    except httpx.TransportError as e:
+                        error = GatewayError(provider, f"{type(e).__name__}: {e}")
+                    else:
+                        if response.status_code < 400:
+                            data = response.json()
+                            usage = data.get("usage") or {}
+                            if usage.get("total_tokens"):
+                                limiter.record_usage(estimate, usage["total_tokens"])
+                            self._settle(provider)
+                            return data
+                        error = GatewayError(provider, f"HTTP {response.status_code}", response.status_code,
+                                             response.text)
+                        retry_after = response.headers.get("retry-after")
+                    finally:
+                        stats["in_flight"] -= 1
+                if not await self._should_retry(provider, limiter, error, attempt, started, retry_after):
+                    stats["errors"] += 1
+                    self._settle(provider, error)
+                    raise error
+                if error.status != 429:
+                    attempt += 1
+        except asyncio.CancelledError:
+            self._settle_cancelled(provider, error, sent_at)
+            raise
+
+    async def stream_chat(self, provider: str, payload: Dict[str, Any],
+                          meta: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """Stream a chat completion and yield the content deltas.
+
+        Retries only happen before the first delta has been yielded. If meta is
+        given it receives the "usage" (when the provider reports it, e.g. Groq's
+        x_groq.usage on the last chunk) and the "finish_reason".
+        """
+        client = self._client(provider)
+        limiter = self._limiter(provider, payload.get("model"))
+        stats = self._stats[provider]
+        payload = dict(payload, stream=True)
+        estimate = estimate_tokens(payload)
+        self._admit(provider)
+        started = time.monotonic()
+        attempt = 0
+        yielded = False
+        error = None
+        sent_at = None
+        try:
+            while True:
+                await limiter.acquire(estimate)
+                retry_after = None
+                async with self._semaphores[provider]:
+                    stats["requests"] += 1
+                    stats["in_flight"] += 1
+                    sent_at = time.monotonic()
+                    try:
+                        async with client.stream("POST", "/chat/completions", json=payload) as response:
+                            if response.status_code >= 400:
+                                body = (await response.aread()).decode("utf-8", "replace")
+                                error = GatewayError(provider, f"HTTP {response.status_code}",
+                                                     response.status_code, body)
+                                retry_after = response.headers.get("retry-after")
+                            else:
+                                async for line in response.aiter_lines():
+                                    if not line.startswith("data:"):
+                                        continue
+                                    data = line[5:].strip()
+                                    if data == "[DONE]":
+                                        break
+                                    chunk = json.loads(data)
+                                    choices = chunk.get("choices") or [{}]
+                                    if meta is not None:
+                                        usage = chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+                                        if usage:
+                                            meta["usage"] = usage
+                                        if choices[0].get("finish_reason"):
+                                            meta["finish_reason"] = choices[0]["finish_reason"]
+                                    delta = choices[0].get("delta", {}).get("content")
+                                    if delta:
+                                        yielded = True
+                                        yield delta
+                                self._settle(provider)
+                                return
+                    except httpx.TransportError as e:
+                        error = GatewayError(provider, f"{type(e).__name__}: {e}")
+                    finally:
+                        stats["in_flight"] -= 1
+                if yielded or not await self._should_retry(provider, limiter, error, attempt, started, retry_after):
+                    stats["errors"] += 1
+                    self._settle(provider, error)
+                    raise error
+                if error.status != 429:
+                    attempt += 1
+        except asyncio.CancelledError:
+            self._settle_cancelled(provider, error, sent_at)
+            raise
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Return per-provider request counters, per-model rate limiter queues and circuit breaker statistics."""
+        limiters = list(self.limiters.items())
+        return {
+            name: dict(stats, circuit=self.breakers[name].stats(), rate_limit={
+                model: limiter.stats() for (provider, model), limiter in limiters if provider == name
+            })
+            for name, stats in self._stats.items()
+        }
@@ -0,0 +1,241 @@
+"""Local OpenAI/Groq-compatible chat completions server for offline load tests.
+
+Serves recorded or templated replies for the prompts ChatMeme sends, with
+configurable latency, token rate and error injection. Point the app at it with
+groq_base_url / xai_base_url = "http://127.0.0.1:8008/v1" in secrets, or run
+benchmarks/llm_throughput.py.
+
+    python mock_llm_server.py --port 8008 --latency-median 0.4 --error-rate 0.02
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+SUBJECTS = ["programmer", "cat", "monday", "coffee", "deadline", "boss", "weekend"]
+
+@dataclass
+class MockConfig:
+    host: str = "127.0.0.1"
+    port: int = 8008
+    latency_median: float = 0.3  # seconds to first token, lognormal
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 300.0
+    error_rate: float = 0.0  # fraction of requests answered with HTTP 500
+    rate_limit_rate: float = 0.0  # fraction answered with HTTP 429 + Retry-After
+    retry_after: float = 1.0
+    malformed_rate: float = 0.0  # fraction of analysis replies with a field missing
+    decommissioned: List[str] = field(default_factory=list)
+    recordings: List[Dict[str, str]] = field(default_factory=list)  # [{"match": ..., "content": ...}]
+    seed: Optional[int] = None
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class MockLLM:
+    """Chooses replies and timings for incoming chat completion requests."""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def roll(self, rate: float) -> bool:
+        with self._lock:
+            return self.random.random() < rate
+
+    def first_token_delay(self) -> float:
+        with self._lock:
+            return self.random.lognormvariate(0, self.config.latency_sigma) * self.config.latency_median
+
+    def reply(self, messages: List[Dict[str, str]]) -> str:
+        system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+        user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        for recording in self.config.recordings:
+            if recording["match"].lower() in (system + "\n" + user).lower():
+                return recording["content"]
+
+        with self._lock:
+            subject = self.random.choice(SUBJECTS)
+        words = [word for word in user.split() if not word.startswith("#")]
+        topic = " ".join(words[-4:]) or subject
+        if "meme analysis expert" in system:
+            data = {
+                "subjects": [subject],
+                "search_queries": [f"{subject} meme", f"{topic} reaction"],
+                "captions": [f"when the {subject} hits different", f"{topic} be like"]
+            }
+        elif "meme expert" in system:
+            data = {"subject": subject, "search_queries": [f"{subject} meme", f"{topic} reaction"],
+                    "caption": f"WHEN {topic.upper()} HITS"}
+        elif "partial" in system and "missing field" in system:
+            start, end = system.rfind("{"), system.rfind("}")
+            field_name = next(iter(json.loads(system[start:end + 1])), "captions")
+            return json.dumps({field_name: [f"{subject} moment"] if field_name.endswith("s") else f"{subject} moment"})
+        elif "formatter" in system and "JSON list" in system:
+            try:
+                texts = json.loads(user)
+            except ValueError:
+                texts = [user]
+            return json.dumps({"captions": [str(text).upper().strip(".!") + "!" for text in texts]})
+        elif "formatter" in system:
+            return user.upper().strip(".!") + "!"
+        elif "running summary" in system:
+            return f"The user and MemeGPT talked about {subject} memes."
+        else:
+            return f"Here's a meme idea about {topic}: a {subject} staring into the void. 😎"
+
+        if self.roll(self.config.malformed_rate):
+            data.pop(next(iter(data)))
+        return json.dumps(data)
+
+def make_handler(llm: MockLLM):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: Dict, headers: Optional[Dict[str, str]] = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_chunk(self, data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model = request.get("model", "mock")
+            llm.requests += 1
+
+            if model in llm.config.decommissioned:
+                self._send_json(400, {"error": {"code": "model_decommissioned", "message": f"{model} is retired"}})
+                return
+            if llm.roll(llm.config.rate_limit_rate):
+                llm.errors += 1
+                self._send_json(429, {"error": {"message": "rate limit"}}, {"Retry-After": str(llm.config.retry_after)})
+                return
+            if llm.roll(llm.config.error_rate):
+                llm.errors += 1
+                self._send_json(500, {"error": {"message": "injected failure"}})
+                return
+
+            messages = request.get("messages", [])
+            content = llm.reply(messages)
+            time.sleep(llm.first_token_delay())
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            usage = {
+                "prompt_tokens": sum(_tokens(m.get("content") or "") for m in messages),
+                "completion_tokens": _tokens(content)
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+            if not request.get("stream"):
+                time.sleep(usage["completion_tokens"] / llm.config.tokens_per_second)
+                self._send_json(200, {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                    "usage": usage
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(content), 4):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + 4]}, "finish_reason": None}]
+                }
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                time.sleep(1 / llm.config.tokens_per_second)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {"usage": usage}
+            }
+            self._send_chunk(f"data: {json.dumps(final)}\n\n".encode("utf-8"))
+            self._send_chunk(b"data: [DONE]\n\n")
+            self._send_chunk(b"")
+
+    return Handler
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops SYNs under load, adding ~1s retransmit delays
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Hedged losers, timeouts and cancelled streams hang up mid-reply; that is expected here
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+def serve(config: MockConfig, background: bool = True) -> ThreadingHTTPServer:
+    """Start the mock server (port 0 picks a free port) and return it."""
+    server = MockHTTPServer((config.host, config.port), make_handler(MockLLM(config)))
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--latency-median", type=float, default=0.3)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--decommission", action="append", default=[], help="model name to reject as retired")
+    parser.add_argument("--recordings", help="JSONL file of {\"match\": ..., \"content\": ...} replies")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    recordings = []
+    if args.recordings:
+        with open(args.recordings) as f:
+            recordings = [json.loads(line) for line in f if line.strip()]
+    config = MockConfig(
+        host=args.host, port=args.port, latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, malformed_rate=args.malformed_rate,
+        decommissioned=args.decommission, recordings=recordings, seed=args.seed
+    )
+    server = serve(config, background=False)
+    print(f"Mock LLM server on http://{config.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
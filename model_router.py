@@ -0,0 +1,106 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Preferred models per call type, best first; later entries are failover targets
+DEFAULT_ROUTES = {
+    "analysis": ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"],
+    "quick_analysis": ["llama-3.3-70b-versatile", "mixtral-8x7b-32768"],
+    "format": ["llama-3.1-8b-instant", "gemma2-9b-it"],
+    "format_batch": ["llama-3.1-8b-instant", "llama-3.3-70b-versatile"],
+    "repair": ["llama-3.1-8b-instant", "llama-3.3-70b-versatile"],
+    "summary": ["llama-3.1-8b-instant", "llama-3.3-70b-versatile"]
+}
+
+def is_decommissioned(status: Optional[int], body: str) -> bool:
+    """True when an API error says the model no longer exists."""
+    return status in (400, 404) and any(
+        marker in body for marker in ("model_decommissioned", "model_not_found", "does not exist")
+    )
+
+class ModelRouter:
+    """Picks the model for each call type and fails over between models.
+
+    Every model keeps an exponentially weighted latency and error rate. A model
+    whose error rate crosses error_threshold, or that fails failure_limit times
+    in a row, is benched for cooldown seconds and the next model in the route
+    takes over; decommissioned models are dropped for good.
+    """
+
+    def __init__(self, routes: Optional[Dict[str, List[str]]] = None, alpha: float = 0.2,
+                 error_threshold: float = 0.5, failure_limit: int = 2, cooldown: float = 60.0):
+        self.routes = {call_type: list(models) for call_type, models in (routes or DEFAULT_ROUTES).items()}
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.failure_limit = failure_limit
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self.decommissioned = set()
+
+    def _model(self, model: str) -> Dict[str, Any]:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = {"calls": 0, "errors": 0, "consecutive_errors": 0, "latency": None, "error_rate": 0.0,
+                     "benched_until": 0.0}
+            self._models[model] = stats
+        return stats
+
+    def primary_model(self, call_type: str) -> str:
+        """The configured first choice for a call type (used for cache keys)."""
+        return self.routes[call_type][0]
+
+    def candidates(self, call_type: str) -> List[str]:
+        """Models to try for a call type, healthy ones first in route order."""
+        now = time.monotonic()
+        with self._lock:
+            models = [model for model in self.routes[call_type] if model not in self.decommissioned]
+            healthy = [model for model in models if self._model(model)["benched_until"] <= now]
+            benched = sorted(
+                (model for model in models if model not in healthy),
+                key=lambda model: self._models[model]["benched_until"]
+            )
+        return healthy + benched
+
+    def record(self, model: str, latency: float, ok: bool):
+        """Update a model's rolling latency and error rate after a call."""
+        with self._lock:
+            stats = self._model(model)
+            stats["calls"] += 1
+            if ok:
+                stats["latency"] = latency if stats["latency"] is None else (
+                    (1 - self.alpha) * stats["latency"] + self.alpha * latency
+                )
+                stats["consecutive_errors"] = 0
+                stats["benched_until"] = 0.0
+            else:
+                stats["errors"] += 1
+                stats["consecutive_errors"] += 1
+            stats["error_rate"] = (1 - self.alpha) * stats["error_rate"] + self.alpha * (0.0 if ok else 1.0)
+            if not ok and (stats["error_rate"] >= self.error_threshold
+                           or stats["consecutive_errors"] >= self.failure_limit):
+                stats["benched_until"] = time.monotonic() + self.cooldown
+
+    def mark_decommissioned(self, model: str):
+        """Stop routing to a model the provider has retired."""
+        with self._lock:
+            self.decommissioned.add(model)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the routing table and per-model rolling scores."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "routes": self.routes,
+                "models": {
+                    model: {
+                        "calls": stats["calls"],
+                        "errors": stats["errors"],
+                        "latency_s": None if stats["latency"] is None else round(stats["latency"], 3),
+                        "error_rate": round(stats["error_rate"], 3),
+                        "benched": stats["benched_until"] > now
+                    }
+                    for model, stats in self._models.items()
+                },
+                "decommissioned": sorted(self.decommissioned)
+            }
@@ -0,0 +1,72 @@
+import re
+import zlib
+from typing import Dict, List
+from similarity_cache import STOPWORDS
+
+# Extra filler seen in chat prompts that never makes a good subject
+PROMPT_FILLER = frozenset({"something", "anything", "thing", "things", "stuff", "kind", "type", "lol", "pls", "plz"})
+
+# Topic keyword -> captions that fit it better than the generic templates
+TOPIC_CAPTIONS = {
+    "code": ["IT WORKS ON MY MACHINE", "ONE DOES NOT SIMPLY\nPUSH TO PROD ON FRIDAY"],
+    "coding": ["IT WORKS ON MY MACHINE", "99 LITTLE BUGS IN THE CODE\nFIX ONE, 127 BUGS IN THE CODE"],
+    "bug": ["IT'S NOT A BUG\nIT'S A FEATURE", "FIXED ONE BUG\nCREATED THREE MORE"],
+    "bugs": ["IT'S NOT A BUG\nIT'S A FEATURE", "FIXED ONE BUG\nCREATED THREE MORE"],
+    "monday": ["MONDAY AGAIN?\nI JUST GOT OVER THE LAST ONE", "ME ON MONDAY MORNING\nLOADING..."],
+    "coffee": ["DON'T TALK TO ME\nBEFORE MY COFFEE", "COFFEE: BECAUSE ADULTING\nIS HARD"],
+    "cat": ["I DID NOT ASK\nFOR YOUR OPINION, HUMAN", "IF I FITS\nI SITS"],
+    "cats": ["I DID NOT ASK\nFOR YOUR OPINION, HUMAN", "IF I FITS\nI SITS"],
+    "dog": ["WHO'S A GOOD BOY?\nME. I'M THE GOOD BOY", "I HAVE NO IDEA\nWHAT I'M DOING"],
+    "work": ["THIS MEETING COULD HAVE\nBEEN AN EMAIL", "ME PRETENDING TO WORK\nWHEN THE BOSS WALKS BY"],
+    "deadline": ["DEADLINE TOMORROW\nME: STARTS TODAY AT 11PM", "I LOVE DEADLINES\nI LOVE THE WHOOSHING SOUND"],
+    "weekend": ["WEEKEND PLANS:\nNOTHING. AND I CAN'T WAIT", "WHEN THE WEEKEND\nFINALLY HITS"],
+}
+
+GENERIC_CAPTIONS = [
+    "WHEN {subject}\nHITS DIFFERENT",
+    "{subject}?\nNOT AGAIN",
+    "NOBODY:\nABSOLUTELY NOBODY: {subject}",
+    "ME EXPLAINING {subject}\nTO MY FRIENDS",
+    "{subject}\nEXPECTATION VS REALITY",
+]
+
+_WORD = re.compile(r"[a-z0-9']+")
+_TAG = re.compile(r"#\S+")
+
+def extract_keywords(prompt: str, limit: int = 3) -> List[str]:
+    """Return the first distinct content words of a prompt, in order."""
+    keywords = []
+    for word in _WORD.findall(_TAG.sub(" ", prompt.lower())):
+        word = word.strip("'")
+        if len(word) > 1 and word not in STOPWORDS and word not in PROMPT_FILLER and word not in keywords:
+            keywords.append(word)
+            if len(keywords) == limit:
+                break
+    return keywords
+
+def analyze_offline(prompt: str) -> Dict:
+    """Build an analysis with the same structure as GroqHandler.analyze_meme_request.
+
+    Uses keyword extraction and caption templates only, so it needs no network
+    and returns in microseconds; captions are already formatted for display.
+    The result carries "offline": True.
+    """
+    keywords = extract_keywords(prompt) or ["mood"]
+    subject = " ".join(keywords[:2])
+    # Deterministic choice per prompt so repeats get the same meme
+    seed = zlib.crc32(prompt.lower().encode("utf-8"))
+
+    captions = []
+    for keyword in keywords:
+        captions.extend(TOPIC_CAPTIONS.get(keyword, ()))
+    if not captions:
+        captions = [template.format(subject=subject.upper()) for template in GENERIC_CAPTIONS]
+    start = seed % len(captions)
+    captions = captions[start:] + captions[:start]
+
+    return {
+        "subjects": [subject] + keywords[2:],
+        "search_queries": [f"{subject} meme", f"{subject} funny", subject],
+        "captions": captions[:3],
+        "offline": True
+    }
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (delta seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Bucket refilled continuously at capacity units per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount units are available (requests above capacity wait for a full bucket)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        self.level -= amount
+
+class RateLimiter:
+    """Client-side scheduler for one provider's requests/min and tokens/min quota.
+
+    Callers queue in FIFO order in acquire() until both buckets have room, so work
+    waits instead of failing with 429. pause() holds the whole queue when the
+    provider answers with Retry-After.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+
+    async def acquire(self, tokens: int = 0):
+        """Wait for a request slot and the estimated number of tokens."""
+        start = time.monotonic()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    wait = self._paused_until - now
+                    if self.requests is not None:
+                        wait = max(wait, self.requests.wait_time(1, now))
+                    if self.tokens is not None and tokens:
+                        wait = max(wait, self.tokens.wait_time(tokens, now))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                if self.requests is not None:
+                    self.requests.consume(1)
+                if self.tokens is not None:
+                    self.tokens.consume(tokens)
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def record_usage(self, estimated: int, actual: int):
+        """Correct the token bucket once the real usage of a request is known."""
+        if self.tokens is not None:
+            self.tokens.consume(actual - estimated)
+
+    def pause(self, seconds: float):
+        """Hold all queued requests for seconds (e.g. from a Retry-After header)."""
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth and wait time statistics."""
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted,
+            "avg_wait_s": round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+            "max_wait_s": round(self.max_wait, 3),
+            "throttled_429": self.throttled
+        }
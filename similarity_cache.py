@@ -0,0 +1,129 @@
+import copy
+import random
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+STOPWORDS = frozenset("""
+a an the about in on of for with to and or but at by from as is are be it its this that these those
+i me my we our you your he she they them some any please can could would just so very
+make create generate give show draw build want need meme memes funny joke jokes picture image
+""".split())
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_SUFFIXES = ("ing", "ers", "er", "ed", "es", "s", "e")
+
+def _stem(word: str) -> str:
+    """Crude suffix stripping, repeated so that "mornings" and "morning" agree."""
+    stripped = True
+    while stripped:
+        stripped = False
+        for suffix in _SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                stripped = True
+                break
+    return word
+
+def shingles(text: str) -> FrozenSet[str]:
+    """Return word stems plus character trigrams of the stems, ignoring filler words and #tags."""
+    text = re.sub(r"#\S+", " ", text.lower())
+    stems = [_stem(word) for word in re.findall(r"[a-z0-9]+", text) if word not in STOPWORDS]
+    result = set(stems)
+    for stem in stems:
+        padded = f" {stem} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(result)
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class SimilarityCache:
+    """Near-duplicate prompt cache backed by a MinHash LSH index.
+
+    Prompts are reduced to word/trigram shingles; MinHash band buckets find
+    candidates in constant time and the exact Jaccard similarity of the shingle
+    sets decides whether a stored value is reused. The index keeps at most
+    max_entries prompts and evicts the least recently used one.
+    """
+
+    def __init__(self, threshold: float = 0.7, max_entries: int = 1000, num_perm: int = 64, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(42)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._entries: "OrderedDict[int, Tuple[str, FrozenSet[str], Tuple[int, ...], Any]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], set] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _signature(self, items: FrozenSet[str]) -> Tuple[int, ...]:
+        hashes = [zlib.crc32(item.encode("utf-8")) for item in items]
+        return tuple(min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms)
+
+    def _band_keys(self, namespace: str, signature: Tuple[int, ...]) -> List[Tuple[str, int, Tuple[int, ...]]]:
+        return [(namespace, band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def get(self, prompt: str, namespace: str = "") -> Optional[Any]:
+        """Return a copy of the value stored for the most similar prompt above the threshold."""
+        items = shingles(prompt)
+        if not items:
+            return None
+        signature = self._signature(items)
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(namespace, signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            best_id, best_score = None, self.threshold
+            for entry_id in candidates:
+                score = jaccard(items, self._entries[entry_id][1])
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return copy.deepcopy(self._entries[best_id][3])
+
+    def add(self, prompt: str, value: Any, namespace: str = ""):
+        """Index a prompt and its value, evicting the least recently used entry if full."""
+        items = shingles(prompt)
+        if not items:
+            return
+        signature = self._signature(items)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (namespace, items, signature, copy.deepcopy(value))
+            for band_key in self._band_keys(namespace, signature):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                old_id, (old_namespace, _, old_signature, _) = self._entries.popitem(last=False)
+                for band_key in self._band_keys(old_namespace, old_signature):
+                    bucket = self._buckets.get(band_key)
+                    if bucket is not None:
+                        bucket.discard(old_id)
+                        if not bucket:
+                            del self._buckets[band_key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the index size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "threshold": self.threshold
+        }
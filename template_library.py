@@ -0,0 +1,138 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+from image_decode import decode_image
+from similarity_cache import STOPWORDS, _stem
+
+# Caption box as fractions of the image size: (left, top, right, bottom)
+Box = Tuple[float, float, float, float]
+
+@dataclass
+class MemeTemplate:
+    """A local meme image with its search metadata and caption boxes."""
+    id: str
+    name: str
+    path: str
+    tags: List[str] = field(default_factory=list)
+    subjects: List[str] = field(default_factory=list)
+    boxes: List[Box] = field(default_factory=lambda: [(0.0, 0.0, 1.0, 0.2), (0.0, 0.8, 1.0, 1.0)])
+
+def tokenize(text: str) -> List[str]:
+    """Return the stems of the content words of text, ignoring #tags."""
+    text = re.sub(r"#\S+", " ", text.lower())
+    return [_stem(word) for word in re.findall(r"[a-z0-9]+", text) if word not in STOPWORDS]
+
+class TemplateLibrary:
+    """Local meme templates found through an in-memory BM25 index.
+
+    The directory holds the images plus a metadata JSON file listing each
+    template's id, name, image file, tags, subjects and caption boxes. Entries
+    whose image is missing are skipped. Only templates containing at least
+    min_coverage of the query terms are candidates; match() returns the best
+    one when its score, normalized to 0..1 by the highest score each query
+    term reaches in the index, is at least threshold.
+    """
+
+    def __init__(self, directory: str, metadata: str = "templates.json", threshold: float = 0.5,
+                 min_coverage: float = 1.0, k1: float = 1.2, b: float = 0.75):
+        self.directory = directory
+        self.threshold = threshold
+        self.min_coverage = min_coverage
+        self.k1 = k1
+        self.b = b
+        self.templates: List[MemeTemplate] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)  # term -> [(template, tf)]
+        self._lengths: List[int] = []
+        self._avg_length = 0.0
+        self.lookups = 0
+        self.matches = 0
+        self._load(os.path.join(directory, metadata))
+
+    def _load(self, path: str):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading meme templates: {str(e)}")
+            return
+        for entry in entries:
+            image_path = os.path.join(self.directory, entry["image"])
+            if not os.path.exists(image_path):
+                continue
+            template = MemeTemplate(
+                id=entry["id"],
+                name=entry.get("name", entry["id"]),
+                path=image_path,
+                tags=entry.get("tags", []),
+                subjects=entry.get("subjects", []),
+            )
+            if entry.get("boxes"):
+                template.boxes = [tuple(box) for box in entry["boxes"]]
+            self._add(template)
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+
+    def _add(self, template: MemeTemplate):
+        terms = tokenize(" ".join([template.name] + template.tags + template.subjects))
+        index = len(self.templates)
+        self.templates.append(template)
+        self._lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            self._postings[term].append((index, tf))
+
+    def _idf(self, term: str) -> float:
+        df = len(self._postings.get(term, ()))
+        return math.log(1 + (len(self.templates) - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, limit: int = 3) -> List[Tuple[MemeTemplate, float]]:
+        """Return up to limit (template, normalized score) pairs, best first."""
+        terms = set(tokenize(query))
+        if not terms or not self.templates:
+            return []
+        scores: Dict[int, float] = defaultdict(float)
+        hits: Dict[int, int] = defaultdict(int)
+        # Reference score: each query term at the highest score it reaches in any template
+        best = 0.0
+        for term in terms:
+            idf = self._idf(term)
+            term_best = 0.0
+            for index, tf in self._postings.get(term, ()):
+                norm = 1 - self.b + self.b * self._lengths[index] / self._avg_length
+                score = idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+                scores[index] += score
+                hits[index] += 1
+                term_best = max(term_best, score)
+            best += term_best
+        needed = math.ceil(self.min_coverage * len(terms))
+        ranked = sorted(
+            (item for item in scores.items() if hits[item[0]] >= needed), key=lambda item: -item[1]
+        )[:limit]
+        return [(self.templates[index], min(1.0, score / best)) for index, score in ranked]
+
+    def match(self, query: str) -> Optional[MemeTemplate]:
+        """Return the best template for the query if it scores above the threshold."""
+        self.lookups += 1
+        results = self.search(query, limit=1)
+        if results and results[0][1] >= self.threshold:
+            self.matches += 1
+            return results[0][0]
+        return None
+
+    def load_image(self, template: MemeTemplate) -> Image.Image:
+        with open(template.path, "rb") as f:
+            return decode_image(f.read())[0].convert("RGB")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "templates": len(self.templates),
+            "terms": len(self._postings),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "match_rate": round(self.matches / self.lookups, 3) if self.lookups else 0.0
+        }
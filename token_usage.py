@@ -0,0 +1,79 @@
+import contextvars
+import math
+import threading
+from collections import defaultdict, deque
+from typing import Any, Dict, Optional
+
+# Set by the app for each script run; propagates into the background loop via run_sync
+current_session: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_session", default=None)
+
+def _percentile(values, p: float) -> int:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] if ordered else 0
+
+class UsageTracker:
+    """Records API token usage per call type and per session.
+
+    It also derives an adaptive max_tokens cap per call type from a high
+    percentile of recent completion lengths plus headroom. Replies cut off at the
+    cap count double, so truncation pushes the cap back up.
+    """
+
+    def __init__(self, window: int = 500, percentile: float = 0.95, headroom: float = 1.25,
+                 min_samples: int = 20, floor: int = 32):
+        self.window = window
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.floor = floor
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.window))
+        self._totals: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "prompt": 0, "completion": 0,
+                                                                        "truncated": 0})
+        self._sessions: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "prompt": 0, "completion": 0})
+
+    def record(self, call_type: str, prompt_tokens: int, completion_tokens: int, truncated: bool = False,
+               session_id: Optional[str] = None):
+        """Record the usage of one completion (session defaults to current_session)."""
+        session_id = session_id or current_session.get()
+        with self._lock:
+            totals = self._totals[call_type]
+            totals["calls"] += 1
+            totals["prompt"] += prompt_tokens
+            totals["completion"] += completion_tokens
+            totals["truncated"] += int(truncated)
+            self._samples[call_type].append(completion_tokens * 2 if truncated else completion_tokens)
+            if session_id:
+                session = self._sessions[session_id]
+                session["calls"] += 1
+                session["prompt"] += prompt_tokens
+                session["completion"] += completion_tokens
+
+    def max_tokens(self, call_type: str, default: int) -> int:
+        """Adaptive completion cap for a call type, never above default."""
+        with self._lock:
+            samples = list(self._samples.get(call_type, ()))
+        if len(samples) < self.min_samples:
+            return default
+        return min(default, max(self.floor, math.ceil(_percentile(samples, self.percentile) * self.headroom)))
+
+    def session_stats(self, session_id: str) -> Dict[str, int]:
+        """Token totals for one session."""
+        with self._lock:
+            return dict(self._sessions.get(session_id, {"calls": 0, "prompt": 0, "completion": 0}))
+
+    def stats(self) -> Dict[str, Any]:
+        """Per call type totals, completion percentiles and the current caps."""
+        with self._lock:
+            result = {}
+            for call_type, totals in self._totals.items():
+                samples = list(self._samples[call_type])
+                result[call_type] = dict(
+                    totals,
+                    p50_completion=_percentile(samples, 0.5),
+                    p95_completion=_percentile(samples, 0.95)
+                )
+            sessions = len(self._sessions)
+        for call_type, stats in result.items():
+            stats["adaptive_cap"] = self.max_tokens(call_type, 10 ** 6) if stats["calls"] >= self.min_samples else None
+        return {"call_types": result, "sessions": sessions}